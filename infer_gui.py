@@ -284,6 +284,7 @@ class SpeechRecognitionApp:
                         rate=self.sample_rate,
                         input=True,
                         frames_per_buffer=self.block_size)
+        text = ''
         async with websockets.connect(f"ws://{args.host}:{args.port_stream}") as websocket:
             while not websocket.closed:
                 data = stream.read(self.block_size)
@@ -293,9 +294,14 @@ class SpeechRecognitionApp:
                 if not self.recording:
                     send_data += b'end'
                 await websocket.send(send_data)
-                result = await websocket.recv()
+                result = json.loads(await websocket.recv())
+                if result['code'] != 0:
+                    logger.error(f"识别失败，错误信息：{result['msg']}")
+                    break
+                # 服务器只返回变化的部分，从offset开始的文本替换为delta
+                text = text[:result['offset']] + result['delta']
                 self.result_text.delete('1.0', 'end')
-                self.result_text.insert(END, f"{json.loads(result)['result']}\n")
+                self.result_text.insert(END, f"{text}\n")
                 # 停止录音后，需要把"end"发给服务器才最终停止
                 if not self.recording and b'end' == send_data[-3:]:
                     logger.info('识别结束')
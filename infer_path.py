@@ -11,12 +11,14 @@ add_arg = functools.partial(add_arguments, argparser=parser)
 add_arg('configs',          str,    'configs/conformer.yml',     "配置文件")
 add_arg('wav_path',         str,    'dataset/test.wav',          "预测音频的路径")
 add_arg('is_long_audio',    bool,   False,                       "是否为长语音")
+add_arg('stream_long_audio', bool,  False,                       "长语音是否分块读取，每识别完成一个语音片段就输出结果")
 add_arg('real_time_demo',   bool,   False,                       "是否使用实时语音识别演示")
 add_arg('use_gpu',          bool,   True,                        "是否使用GPU预测")
 add_arg('use_pun',          bool,   False,                       "是否给识别结果加标点符号")
 add_arg('is_itn',           bool,   False,                       "是否对文本进行反标准化")
 add_arg('pun_model_dir',    str,    'models/pun_models/',        "加标点符号的模型文件夹路径")
 add_arg('model_path',       str,    'models/conformer_streaming_fbank/infer',       "导出的预测模型文件路径")
+add_arg('optim_cache_dir',  str,    None,                        "保存IR优化之后的模型的文件夹，之后启动时直接加载，为None时不使用")
 args = parser.parse_args()
 print_arguments(args=args)
 
@@ -25,12 +27,19 @@ predictor = PPASRPredictor(configs=args.configs,
                            model_path=args.model_path,
                            use_gpu=args.use_gpu,
                            use_pun=args.use_pun,
-                           pun_model_dir=args.pun_model_dir)
+                           pun_model_dir=args.pun_model_dir,
+                           is_itn=args.is_itn,
+                           optim_cache_dir=args.optim_cache_dir)
 
 
 # 长语音识别
 def predict_long_audio():
     start = time.time()
+    if args.stream_long_audio:
+        for result in predictor.predict_long_stream(audio_data=args.wav_path, use_pun=args.use_pun, is_itn=args.is_itn):
+            print(f"[{result['start']}s - {result['end']}s]，消耗时间：{int(round((time.time() - start) * 1000))}, "
+                  f"识别结果: {result['text']}, 得分: {result['score']}")
+        return
     result = predictor.predict_long(audio_data=args.wav_path, use_pun=args.use_pun, is_itn=args.is_itn)
     score, text = result['score'], result['text']
     print(f"长语音识别结果，消耗时间：{int(round((time.time() - start) * 1000))}, 识别结果: {text}, 得分: {score}")
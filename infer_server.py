@@ -1,19 +1,26 @@
-import _thread
 import argparse
 import asyncio
 import functools
+import json
 import os
-import sys
+import threading
 import time
-import wave
-from datetime import datetime
-from typing import List
 
-import websockets
-from flask import request, Flask, render_template
-from flask_cors import CORS
-from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, File, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse
+from fastapi.staticfiles import StaticFiles
 
+from ppasr.data_utils.audio import AudioSegment
+from ppasr.infer_utils.archive_writer import ArchiveWriter
+from ppasr.infer_utils.batch_scheduler import BatchScheduler
+from ppasr.infer_utils.predictor_pool import PredictorPool, PoolBusyError
+from ppasr.infer_utils.stream_engine import StreamingEngine
+from ppasr.infer_utils.stream_punctuator import StreamPunctuator
+from ppasr.infer_utils.vad_endpointer import VADEndpointer
+from ppasr.infer_utils.vad_predictor import VADPredictor
 from ppasr.predict import PPASRPredictor
 from ppasr.utils.logger import setup_logger
 from ppasr.utils.utils import add_arguments, print_arguments
@@ -27,178 +34,264 @@ add_arg("host",             str,    '0.0.0.0',            "监听主机的IP地
 add_arg("port_server",      int,    5000,                 "普通识别服务所使用的端口号")
 add_arg("port_stream",      int,    5001,                 "流式识别服务所使用的端口号")
 add_arg("save_path",        str,    'dataset/upload/',    "上传音频文件的保存目录")
+add_arg('save_upload',      bool,   True,   "是否在后台保存上传的音频文件，不影响识别的速度")
+add_arg('save_stream',      bool,   True,   "是否在后台保存流式识别的录音，不影响识别的速度")
+add_arg('archive_format',   str,    'wav',  "流式识别录音保存的格式，支持：wav、flac、opus")
+add_arg('archive_max_days', int,    0,      "保存的音频保留的天数，为0时不删除")
+add_arg('archive_max_size_mb', int, 0,      "保存的音频最大的总大小，单位MB，为0时不限制")
+add_arg('archive_queue_size', int,  100,    "等待保存的音频最大数量，队列满时丢弃新的音频")
 add_arg('use_gpu',          bool,   True,   "是否使用GPU预测")
 add_arg('use_pun',          bool,   False,  "是否给识别结果加标点符号")
 add_arg('is_itn',           bool,   False,  "是否对文本进行反标准化")
-add_arg('num_web_p',        int,    2,      "多少个预测器，这个是Web服务并发的数量，必须大于等于1")
-add_arg('num_websocket_p',  int,    2,      "多少个预测器，这个是WebSocket同时连接的数量，必须大于等于1")
+add_arg('itn_cache_dir',    str,    None,   "保存编译好的文本反标准化FST的文件夹，多个服务可以共享，为None时使用WeTextProcessing自带的FST")
+add_arg('num_web_p',        int,    2,      "多少个预测器，这个是Web服务短语音和长语音识别各自并发的数量，必须大于等于1")
+add_arg('num_websocket_p',  int,    2,      "多少个预测器，这个是WebSocket服务共享的预测器数量，必须大于等于1")
+add_arg('max_stream_sessions', int, 100,    "WebSocket服务最多同时连接的数量")
+add_arg('vad_endpoint',     bool,   True,   "WebSocket服务是否使用VAD丢弃静音，并在静音超时后自动结束一句话")
+add_arg('endpoint_silence_ms', int, 800,    "静音超过这个长度自动结束一句话，单位毫秒")
+add_arg('batch_size',       int,    16,     "短语音识别动态批量的最大批量大小")
+add_arg('batch_wait_ms',    int,    10,     "短语音识别请求最多等待合并批量的时间，单位毫秒")
+add_arg('batch_buckets',    str,    '2,5,10,20',    "短语音识别按音频长度分桶的边界，单位秒，用逗号分隔")
+add_arg('max_queue_size',   int,    256,    "短语音识别最多排队的请求数量，超过之后直接拒绝新的请求")
+add_arg('max_waiting',      int,    32,     "长语音识别最多等待空闲预测器的请求数量，超过之后直接拒绝新的请求")
+add_arg('request_timeout',  float,  60,     "每个识别请求的超时时间，单位秒")
+add_arg('long_audio_timeout', float, 0,     "长语音识别请求的超时时间，单位秒，为0时不限制")
 add_arg('model_path',       str,    'models/conformer_streaming_fbank/infer',   "导出的预测模型文件路径")
 add_arg('pun_model_dir',    str,    'models/pun_models/',    "加标点符号的模型文件夹路径")
+add_arg('optim_cache_dir',  str,    None,   "保存IR优化之后的模型的文件夹，重启和扩容时直接加载，为None时不使用")
 args = parser.parse_args()
 print_arguments(args=args)
 
-app = Flask('PPASR', template_folder="templates", static_folder="static", static_url_path="/")
-# 允许跨越访问
-CORS(app)
-
 assert args.num_web_p >= 1, f'Web服务的预测器数量必须大于等于1，当前为：{args.num_web_p}'
 assert args.num_websocket_p >= 1, f'WebSocket服务的预测器数量必须大于等于1，当前为：{args.num_websocket_p}'
 
-# 多进程
-executor = ProcessPoolExecutor(max_workers=args.num_web_p)
-# 创建预测器，是实时语音的第一个对象和创建多进程时使用
-predictor = PPASRPredictor(configs=args.configs,
-                           model_path=args.model_path,
-                           use_gpu=args.use_gpu,
-                           use_pun=args.use_pun,
-                           pun_model_dir=args.pun_model_dir)
-# 创建多个预测器，实时语音识别所以要这样处理
-predictors: List[PPASRPredictor] = [predictor]
+app = FastAPI(title='PPASR')
+# 允许跨越访问
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+
+# 只加载一次模型、语言模型、标点符号模型和文本反标准化工具，其他预测器都是共享权重的复制，创建时会执行预热，服务启动之后第一次请求不会变慢
+base_predictor = PPASRPredictor(configs=args.configs,
+                                model_path=args.model_path,
+                                use_gpu=args.use_gpu,
+                                use_pun=args.use_pun,
+                                pun_model_dir=args.pun_model_dir,
+                                is_itn=args.is_itn,
+                                itn_cache_dir=args.itn_cache_dir,
+                                optim_cache_dir=args.optim_cache_dir)
+
+
+def create_predictor():
+    return base_predictor.clone()
+
+
+# 短语音识别的动态批量调度器，多个预测器同时从队列中获取批量，模型只能单条推理时也可以并发识别
+batch_scheduler = BatchScheduler(predictors=[create_predictor() for _ in range(args.num_web_p)],
+                                 max_batch_size=args.batch_size,
+                                 max_wait_ms=args.batch_wait_ms,
+                                 bucket_boundaries=[float(b) for b in args.batch_buckets.split(',') if b != ''],
+                                 use_pun=args.use_pun,
+                                 is_itn=args.is_itn)
+# 长语音识别的预测器池
+long_audio_pool = PredictorPool(predictors=[create_predictor() for _ in range(args.num_web_p)],
+                                max_waiting=args.max_waiting)
+# 多会话流式识别引擎，多个WebSocket连接共享预测器
+# 流式识别的增量标点符号在单独的线程中执行，使用复制的标点符号模型
+stream_punctuator = StreamPunctuator(base_predictor.pun_predictor.clone()) \
+    if args.use_pun and base_predictor.pun_predictor is not None else None
+stream_engine = StreamingEngine(predictors=[create_predictor() for _ in range(args.num_websocket_p)],
+                                max_sessions=args.max_stream_sessions,
+                                use_pun=args.use_pun,
+                                is_itn=args.is_itn,
+                                punctuator=stream_punctuator)
+
+# 后台保存音频，不会阻塞事件循环
+archive_writer = ArchiveWriter(save_path=args.save_path,
+                               audio_format=args.archive_format,
+                               max_queue_size=args.archive_queue_size,
+                               max_days=args.archive_max_days,
+                               max_size_mb=args.archive_max_size_mb)
 
 
-# 多进行推理需要用到的
-def run_model_recognition(file_path, is_long_audio=False):
-    if is_long_audio:
-        result = predictor.predict_long(audio_data=file_path, use_pun=args.use_pun, is_itn=args.is_itn)
-    else:
-        result = predictor.predict(audio_data=file_path, use_pun=args.use_pun, is_itn=args.is_itn)
-    return result
+def error_response(code, msg, status_code=200):
+    return JSONResponse(status_code=status_code, content={"code": code, "msg": msg})
+
+
+# 在后台保存上传的音频文件，识别不需要等待保存完成
+def archive_upload(audio: UploadFile, data: bytes):
+    if not args.save_upload: return
+    archive_writer.archive_file(data, suffix=os.path.splitext(audio.filename)[-1])
 
 
 # 语音识别接口
-@app.route("/recognition", methods=['POST'])
-def recognition():
-    f = request.files['audio']
-    if f:
-        # 保存路径
-        save_dir = os.path.join(args.save_path, datetime.now().strftime('%Y-%m-%d'))
-        os.makedirs(save_dir, exist_ok=True)
-        file_path = os.path.join(save_dir, f'{int(time.time() * 1000)}{os.path.splitext(f.filename)[-1]}')
-        f.save(file_path)
-        try:
-            start = time.time()
-            # 执行识别
-            result = executor.submit(run_model_recognition, file_path, is_long_audio=False).result()
-            score, text = result['score'], result['text']
-            end = time.time()
-            print("识别时间：%dms，识别结果：%s， 得分: %f" % (round((end - start) * 1000), text, score))
-            result = str({"code": 0, "msg": "success", "result": text, "score": round(score, 3)}).replace("'", '"')
-            return result
-        except Exception as e:
-            print(f'[{datetime.now()}] 短语音识别失败，错误信息：{e}', file=sys.stderr)
-            return str({"error": 1, "msg": "audio read fail!"})
-    return str({"error": 3, "msg": "audio is None!"})
+@app.post("/recognition")
+async def recognition(audio: UploadFile = File(None)):
+    if audio is None:
+        return error_response(3, "audio is None!")
+    # 排队的请求太多时直接拒绝，避免请求全部超时
+    if batch_scheduler.queue_depth >= args.max_queue_size:
+        return error_response(5, "server busy!", status_code=503)
+    data = await audio.read()
+    archive_upload(audio, data)
+    loop = asyncio.get_running_loop()
+    try:
+        start = time.time()
+        # 直接在内存中解码音频，不需要写入临时文件
+        audio_segment = await loop.run_in_executor(None, AudioSegment.from_bytes, data)
+        # 执行识别，多个请求会被合并成一个批量推理
+        future = batch_scheduler.submit(audio_segment)
+        result = await asyncio.wait_for(asyncio.wrap_future(future), args.request_timeout)
+        score, text = result['score'], result['text']
+        logger.info(f"识别时间：{round((time.time() - start) * 1000)}ms，识别结果：{text}， 得分: {score}")
+        return JSONResponse({"code": 0, "msg": "success", "result": text, "score": round(score, 3)})
+    except asyncio.TimeoutError:
+        logger.error(f'短语音识别超时：{audio.filename}')
+        return error_response(4, "recognition timeout!", status_code=504)
+    except Exception as e:
+        logger.error(f'短语音识别失败，错误信息：{e}')
+        return error_response(1, "audio read fail!")
 
 
 # 长语音识别接口
-@app.route("/recognition_long_audio", methods=['POST'])
-def recognition_long_audio():
-    f = request.files['audio']
-    if f:
-        # 保存路径
-        save_dir = os.path.join(args.save_path, datetime.now().strftime('%Y-%m-%d'))
-        os.makedirs(save_dir, exist_ok=True)
-        file_path = os.path.join(save_dir, f'{int(time.time() * 1000)}{os.path.splitext(f.filename)[-1]}')
-        f.save(file_path)
-        try:
-            start = time.time()
-            result = executor.submit(run_model_recognition, file_path, is_long_audio=True).result()
-            score, text = result['score'], result['text']
-            end = time.time()
-            print("识别时间：%dms，识别结果：%s， 得分: %f" % (round((end - start) * 1000), text, score))
-            result = str({"code": 0, "msg": "success", "result": text, "score": score}).replace("'", '"')
-            return result
-        except Exception as e:
-            print(f'[{datetime.now()}] 长语音识别失败，错误信息：{e}', file=sys.stderr)
-            return str({"error": 1, "msg": "audio read fail!"})
-    return str({"error": 3, "msg": "audio is None!"})
-
-
-@app.route('/')
-def home():
-    return render_template("index.html")
+@app.post("/recognition_long_audio")
+async def recognition_long_audio(audio: UploadFile = File(None)):
+    if audio is None:
+        return error_response(3, "audio is None!")
+    data = await audio.read()
+    archive_upload(audio, data)
+    cancel_event = threading.Event()
+    try:
+        start = time.time()
+        # 音频字节直接交给预测器在工作线程中解码，超时之后通知预测器停止识别，尽快把预测器放回预测器池
+        result = await long_audio_pool.run(lambda p: p.predict_long(audio_data=data, use_pun=args.use_pun,
+                                                                    is_itn=args.is_itn, cancel_event=cancel_event),
+                                           timeout=args.long_audio_timeout if args.long_audio_timeout > 0 else None)
+        score, text = result['score'], result['text']
+        logger.info(f"识别时间：{round((time.time() - start) * 1000)}ms，识别结果：{text}， 得分: {score}")
+        return JSONResponse({"code": 0, "msg": "success", "result": text, "score": score})
+    except PoolBusyError:
+        return error_response(5, "server busy!", status_code=503)
+    except asyncio.CancelledError:
+        # 客户端断开连接，不需要继续识别
+        cancel_event.set()
+        raise
+    except asyncio.TimeoutError:
+        cancel_event.set()
+        logger.error(f'长语音识别超时：{audio.filename}')
+        return error_response(4, "recognition timeout!", status_code=504)
+    except Exception as e:
+        logger.error(f'长语音识别失败，错误信息：{e}')
+        return error_response(1, "audio read fail!")
+
+
+# 识别队列的统计信息
+@app.get("/queue_status")
+async def queue_status():
+    return JSONResponse({"code": 0, "msg": "success",
+                         "result": batch_scheduler.stats(),
+                         "long_audio": long_audio_pool.stats(),
+                         "archive": archive_writer.stats(),
+                         "stream": {"num_sessions": stream_engine.num_sessions,
+                                    "max_sessions": stream_engine.max_sessions}})
+
+
+@app.get('/')
+async def home():
+    return FileResponse('templates/index.html')
 
 
 # 流式识别WebSocket服务
-async def stream_server_run(websocket, path):
-    logger.info(f'有WebSocket连接建立：{websocket.remote_address}')
-    # 寻找空闲的预测器
-    use_predictor = None
-    for predictor2 in predictors:
-        if predictor2.running: continue
-        use_predictor = predictor2
-        use_predictor.running = True
-        break
-    if use_predictor is not None:
-        frames = []
-        score, text = 0, ""
-        while not websocket.closed:
+@app.websocket('/')
+async def stream_server_run(websocket: WebSocket):
+    await websocket.accept()
+    logger.info(f'有WebSocket连接建立：{websocket.client}')
+    # 创建会话，会话的识别状态不占用预测器，多个会话共享预测器
+    session = stream_engine.create_session()
+    if session is None:
+        logger.error(f'语音识别失败，连接数量已达到上限')
+        await websocket.send_text(json.dumps({"code": 1, "msg": "recognition fail, no resource!"}))
+        await websocket.close()
+        return
+    loop = asyncio.get_running_loop()
+    # 每个连接使用单独的VAD状态，推理会话是共享的
+    endpointer = VADEndpointer(VADPredictor(), endpoint_silence_ms=args.endpoint_silence_ms) \
+        if args.vad_endpoint else None
+    frames = []
+    # 已经结束的句子和当前句子的识别结果，已经结束的句子不会再改变，
+    # sent_fixed_len为上一次发送时已经结束的句子的长度，sent_tail为上一次发送的文本在这之后的部分
+    finished_text, current_text = '', ''
+    sent_fixed_len, sent_tail = 0, ''
+    separator = '' if args.use_pun else '，'
+    try:
+        while True:
+            data = await websocket.receive_bytes()
+            if len(data) == 0: continue
+            is_end = False
+            # 判断是不是结束预测
+            if b'end' == data[-3:]:
+                is_end = True
+                data = data[:-3]
+            frames.append(data)
             try:
-                data = await websocket.recv()
-                frames.append(data)
-                if len(data) == 0: continue
-                is_end = False
-                # 判断是不是结束预测
-                if b'end' == data[-3:]:
-                    is_end = True
-                    data = data[:-3]
-                # 开始预测
-                result = use_predictor.predict_stream(audio_data=data, use_pun=args.use_pun, is_itn=args.is_itn,
-                                                      is_end=is_end)
-                if result is not None:
-                    score, text = result['score'], result['text']
-                send_data = str({"code": 0, "result": text}).replace("'", '"')
+                samples = np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768
+                # 丢弃静音，静音超时时自动结束一句话
+                if endpointer is not None:
+                    segments = await loop.run_in_executor(None, endpointer.process, samples, is_end)
+                else:
+                    segments = [(samples, is_end)]
+                for segment, segment_end in segments:
+                    # 开始预测
+                    future = stream_engine.push(session, audio_data=segment, is_end=segment_end)
+                    result = await asyncio.wait_for(asyncio.wrap_future(future), args.request_timeout)
+                    if result is not None:
+                        current_text = result['text']
+                    if segment_end:
+                        if current_text != '':
+                            finished_text = finished_text + separator + current_text if finished_text else current_text
+                        current_text = ''
+                # 只比较上一次发送之后可能变化的部分，不需要扫描整个会话的文本
+                tail = finished_text[sent_fixed_len:] + \
+                    (separator if finished_text and current_text else '') + current_text
+                offset = sent_fixed_len + len(os.path.commonprefix([sent_tail, tail]))
+                delta = tail[offset - sent_fixed_len:]
+                sent_tail = tail[len(finished_text) - sent_fixed_len:]
+                sent_fixed_len = len(finished_text)
+                send_data = json.dumps({"code": 0, "type": "final" if is_end else "partial",
+                                        "offset": offset, "delta": delta}, ensure_ascii=False)
                 logger.info(f'向客户端发生消息：{send_data}')
-                await websocket.send(send_data)
-                # 结束了要关闭当前的连接
-                if is_end: await websocket.close()
+                await websocket.send_text(send_data)
+            except WebSocketDisconnect:
+                raise
             except Exception as e:
                 logger.error(f'识别发生错误：错误信息：{e}')
-                try:
-                    await websocket.send(str({"code": 2, "msg": "recognition fail!"}).replace("'", '"'))
-                except:pass
-        # 重置流式识别
-        use_predictor.reset_stream()
-        use_predictor.running = False
-        # 保存录音
-        save_dir = os.path.join(args.save_path, datetime.now().strftime('%Y-%m-%d'))
-        os.makedirs(save_dir, exist_ok=True)
-        file_path = os.path.join(save_dir, f'{int(time.time() * 1000)}.wav')
-        audio_bytes = b''.join(frames)
-        wf = wave.open(file_path, 'wb')
-        wf.setnchannels(1)
-        wf.setsampwidth(2)
-        wf.setframerate(16000)
-        wf.writeframes(audio_bytes)
-        wf.close()
-    else:
-        logger.error(f'语音识别失败，预测器不足')
-        await websocket.send(str({"code": 1, "msg": "recognition fail, no resource!"}).replace("'", '"'))
-        await websocket.close()
+                await websocket.send_text(json.dumps({"code": 2, "msg": "recognition fail!"}))
+            # 结束了要关闭当前的连接
+            if is_end:
+                await websocket.close()
+                break
+    except WebSocketDisconnect:
+        logger.info(f'WebSocket连接已断开：{websocket.client}')
+    finally:
+        # 关闭会话
+        stream_engine.close_session(session)
+    # 保存录音
+    if args.save_stream:
+        archive_writer.archive_pcm(b''.join(frames), sample_rate=16000)
+
+
+# 静态文件放在最后，不会覆盖上面的接口
+app.mount('/', StaticFiles(directory='static'), name='static')
 
 
-# 因为有多个服务需要使用线程启动
-def start_server_thread():
-    app.run(host=args.host, port=args.port_server)
+async def main():
+    # HTTP和WebSocket接口由同一个应用提供，同时监听两个端口，兼容原来使用流式识别端口的客户端
+    servers = [uvicorn.Server(uvicorn.Config(app, host=args.host, port=port, log_level='warning'))
+               for port in sorted({args.port_server, args.port_stream})]
+    logger.info(f'服务已启动，访问地址：http://{args.host}:{args.port_server}')
+    await asyncio.gather(*[server.serve() for server in servers])
 
 
 if __name__ == '__main__':
-    # 实时语音识别所以要这样处理
-    for _ in range(args.num_websocket_p - 1):
-        predictor1 = PPASRPredictor(configs=args.configs,
-                                    model_path=args.model_path,
-                                    use_gpu=args.use_gpu,
-                                    use_pun=args.use_pun,
-                                    pun_model_dir=args.pun_model_dir)
-        predictors.append(predictor1)
     # 创建保存路径
-    if not os.path.exists(args.save_path):
-        os.makedirs(args.save_path)
-    # 启动web服务
-    _thread.start_new_thread(start_server_thread, ())
-    logger.warning('因为是多进程，所以第一次访问比较慢是正常，后面速度就会恢复了！')
-    # 启动Flask服务
-    server = websockets.serve(stream_server_run, args.host, args.port_stream)
-    # 启动WebSocket服务
-    asyncio.get_event_loop().run_until_complete(server)
-    asyncio.get_event_loop().run_forever()
+    os.makedirs(args.save_path, exist_ok=True)
+    asyncio.run(main())
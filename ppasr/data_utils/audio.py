@@ -115,7 +115,12 @@ class AudioSegment(object):
         :return: 音频部分实例
         :rtype: AudioSegment
         """
-        samples, sample_rate = soundfile.read(io.BytesIO(data), dtype='float32')
+        try:
+            samples, sample_rate = soundfile.read(io.BytesIO(data), dtype='float32')
+        except:
+            # 支持更多格式数据
+            sample_rate = 16000
+            samples = decode_audio(file=io.BytesIO(data), sample_rate=sample_rate)
         return cls(samples, sample_rate)
 
     @classmethod
@@ -1,8 +1,18 @@
+from functools import lru_cache
+
 import numpy as np
-import paddle
-from paddleaudio.compliance.kaldi import mfcc, fbank
 
 from ppasr.data_utils.audio import AudioSegment
+from ppasr.data_utils.featurizer import kaldi
+
+
+@lru_cache(maxsize=16)
+def _get_linear_weighting(window_size, sample_rate):
+    """获取线性谱图的汉宁窗和功率谱的缩放系数，只与配置有关，第一次使用时创建"""
+    weighting = np.hanning(window_size)[:, None]
+    weighting.flags.writeable = False
+    scale = np.sum(weighting ** 2) * sample_rate
+    return weighting, scale
 
 
 class AudioFeaturizer(object):
@@ -14,6 +24,8 @@ class AudioFeaturizer(object):
     :type use_dB_normalization: bool
     :param target_dB: 对音频进行音量归一化的音量分贝值
     :type target_dB: float
+    :param feature_backend: 计算Fbank和MFCC的后端，支持paddle、numpy，numpy后端不需要创建paddle的Tensor
+    :type feature_backend: str
     :param train: 是否训练使用
     :type train: bool
     """
@@ -25,6 +37,7 @@ class AudioFeaturizer(object):
                  sample_rate=16000,
                  use_dB_normalization=True,
                  target_dB=-20,
+                 feature_backend='numpy',
                  train=False):
         self._feature_method = feature_method
         self._target_sample_rate = sample_rate
@@ -32,6 +45,8 @@ class AudioFeaturizer(object):
         self._n_mfcc = n_mfcc
         self._use_dB_normalization = use_dB_normalization
         self._target_dB = target_dB
+        assert feature_backend in ['paddle', 'numpy'], f'没有{feature_backend}特征计算后端'
+        self._feature_backend = feature_backend
         self._train = train
 
     def featurize(self, audio_segment):
@@ -49,6 +64,16 @@ class AudioFeaturizer(object):
         if self._use_dB_normalization:
             audio_segment.normalize(target_db=self._target_dB)
         # extract spectrogram
+        return self.extract_features(audio_segment)
+
+    def extract_features(self, audio_segment):
+        """从AudioSegment中提取音频特征，不执行重采样和音量归一化
+
+        :param audio_segment: Audio segment to extract features from.
+        :type audio_segment: AudioSegment
+        :return: Spectrogram audio feature in 2darray.
+        :rtype: ndarray
+        """
         if self._feature_method == 'linear':
             samples = audio_segment.samples
             return self._compute_linear(samples=samples, sample_rate=audio_segment.sample_rate)
@@ -78,13 +103,12 @@ class AudioFeaturizer(object):
         nshape = (window_size, (len(samples) - window_size) // stride_size + 1)
         nstrides = (samples.strides[0], samples.strides[0] * stride_size)
         windows = np.lib.stride_tricks.as_strided(samples, shape=nshape, strides=nstrides)
-        assert np.all(windows[:, 1] == samples[stride_size:(stride_size + window_size)])
+        assert nshape[1] == 1 or np.all(windows[:, 1] == samples[stride_size:(stride_size + window_size)])
         # 快速傅里叶变换
-        weighting = np.hanning(window_size)[:, None]
+        weighting, scale = _get_linear_weighting(window_size, sample_rate)
         fft = np.fft.rfft(windows * weighting, n=None, axis=0)
         fft = np.absolute(fft)
         fft = fft ** 2
-        scale = np.sum(weighting ** 2) * sample_rate
         fft[1:-1, :] *= (2.0 / scale)
         fft[(0, -1), :] /= scale
         freqs = float(sample_rate) / window_size * np.arange(fft.shape[0])
@@ -104,6 +128,16 @@ class AudioFeaturizer(object):
                       dither=1.0,
                       train=False):
         dither = dither if train else 0.0
+        if self._feature_backend == 'numpy':
+            return kaldi.mfcc(samples,
+                              n_mels=n_mels,
+                              n_mfcc=n_mfcc,
+                              frame_length=frame_length,
+                              frame_shift=frame_shift,
+                              dither=dither,
+                              sr=sample_rate)
+        import paddle
+        from paddleaudio.compliance.kaldi import mfcc
         waveform = paddle.to_tensor(np.expand_dims(samples, 0), dtype=paddle.float32)
         # 计算MFCC
         mfcc_feat = mfcc(waveform,
@@ -126,6 +160,15 @@ class AudioFeaturizer(object):
                        dither=1.0,
                        train=False):
         dither = dither if train else 0.0
+        if self._feature_backend == 'numpy':
+            return kaldi.fbank(samples,
+                               n_mels=n_mels,
+                               frame_length=frame_length,
+                               frame_shift=frame_shift,
+                               dither=dither,
+                               sr=sample_rate)
+        import paddle
+        from paddleaudio.compliance.kaldi import fbank
         waveform = paddle.to_tensor(np.expand_dims(samples, 0), dtype=paddle.float32)
         # 计算Fbank
         mat = fbank(waveform,
@@ -137,6 +180,25 @@ class AudioFeaturizer(object):
         fbank_feat = mat.numpy()  # (T, 161)
         return fbank_feat
 
+    @property
+    def frame_length(self):
+        """返回每一帧的采样点数
+
+        :return: 每一帧的采样点数
+        :rtype: int
+        """
+        frame_length = 20.0 if self._feature_method == 'linear' else 25.0
+        return int(0.001 * self._target_sample_rate * frame_length)
+
+    @property
+    def frame_shift(self):
+        """返回帧移的采样点数
+
+        :return: 帧移的采样点数
+        :rtype: int
+        """
+        return int(0.001 * self._target_sample_rate * 10.0)
+
     @property
     def feature_dim(self):
         """返回特征大小
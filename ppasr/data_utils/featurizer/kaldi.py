@@ -0,0 +1,176 @@
+"""使用NumPy实现的与Kaldi兼容的Fbank和MFCC特征，计算结果与paddleaudio.compliance.kaldi一致，
+推理时不需要创建paddle的Tensor。窗函数、Mel滤波器组等只与配置有关的矩阵会在第一次使用时创建并缓存"""
+import math
+from functools import lru_cache
+
+import numpy as np
+
+__all__ = ['fbank', 'mfcc']
+
+EPSILON = np.finfo(np.float32).eps
+
+
+def _next_power_of_2(x):
+    return 1 if x == 0 else 2 ** (x - 1).bit_length()
+
+
+def _mel_scale(freq):
+    return 1127.0 * np.log(1.0 + freq / 700.0)
+
+
+def _read_only(array):
+    # 缓存的矩阵会被多次调用共享，不允许修改
+    array.flags.writeable = False
+    return array
+
+
+@lru_cache(maxsize=16)
+def _get_frame_transform(window_size, padded_window_size, preemph_coeff, remove_dc_offset):
+    """获取把一帧音频转换为频谱实部和虚部的矩阵，大小为(window_size, 2 * (padded_window_size // 2 + 1))
+
+    去直流、预加重、加窗和离散傅里叶变换都是线性变换，合并成一个矩阵之后，
+    所有帧的频谱只需要一次矩阵乘法就能计算出来
+    """
+    transform = np.eye(window_size, dtype=np.float64)
+    if remove_dc_offset:
+        transform -= 1.0 / window_size
+    if preemph_coeff != 0.0:
+        preemph = np.eye(window_size, dtype=np.float64)
+        preemph[0, 0] -= preemph_coeff
+        preemph[np.arange(window_size - 1), np.arange(1, window_size)] = -preemph_coeff
+        transform = np.matmul(transform, preemph)
+    # povey窗
+    transform *= np.power(np.hanning(window_size), 0.85)[np.newaxis, :]
+    # 补零之后的离散傅里叶变换只需要前window_size个点
+    n = np.arange(window_size, dtype=np.float64)[:, np.newaxis]
+    k = np.arange(padded_window_size // 2 + 1, dtype=np.float64)[np.newaxis, :]
+    angle = 2.0 * math.pi * n * k / padded_window_size
+    dft = np.concatenate([np.cos(angle), -np.sin(angle)], axis=1)
+    return _read_only(np.matmul(transform, dft).astype(np.float32))
+
+
+@lru_cache(maxsize=16)
+def _get_mel_banks(n_mels, padded_window_size, sr, low_freq, high_freq):
+    """获取转置后的Mel滤波器组，大小为(padded_window_size // 2 + 1, n_mels)"""
+    num_fft_bins = padded_window_size // 2
+    nyquist = 0.5 * sr
+    if high_freq <= 0.0:
+        high_freq += nyquist
+    assert 0.0 <= low_freq < nyquist and 0.0 < high_freq <= nyquist and low_freq < high_freq, \
+        f'错误的频率范围，low_freq：{low_freq}，high_freq：{high_freq}，nyquist：{nyquist}'
+    fft_bin_width = sr / padded_window_size
+    mel_low_freq = _mel_scale(low_freq)
+    mel_high_freq = _mel_scale(high_freq)
+    mel_freq_delta = (mel_high_freq - mel_low_freq) / (n_mels + 1)
+
+    bins = np.arange(n_mels, dtype=np.float64)[:, np.newaxis]
+    left_mel = mel_low_freq + bins * mel_freq_delta
+    center_mel = mel_low_freq + (bins + 1.0) * mel_freq_delta
+    right_mel = mel_low_freq + (bins + 2.0) * mel_freq_delta
+
+    mel = _mel_scale(fft_bin_width * np.arange(num_fft_bins, dtype=np.float64))[np.newaxis, :]
+    up_slope = (mel - left_mel) / (center_mel - left_mel)
+    down_slope = (right_mel - mel) / (right_mel - center_mel)
+    mel_banks = np.maximum(0.0, np.minimum(up_slope, down_slope))
+    # 最后一个频点的权重为0，转置之后可以直接与功率谱相乘
+    mel_banks = np.pad(mel_banks, ((0, 0), (0, 1)))
+    return _read_only(np.ascontiguousarray(mel_banks.T).astype(np.float32))
+
+
+@lru_cache(maxsize=16)
+def _get_dct_matrix(n_mels, n_mfcc, cepstral_lifter):
+    """获取DCT-II矩阵，大小为(n_mels, n_mfcc)，第一列与Kaldi一致使用sqrt(1/n_mels)，倒谱提升也合并到矩阵中"""
+    n = np.arange(n_mels, dtype=np.float64)
+    k = np.arange(n_mfcc, dtype=np.float64)[:, np.newaxis]
+    dct = np.cos(math.pi / n_mels * (n + 0.5) * k) * math.sqrt(2.0 / n_mels)
+    dct[0] = math.sqrt(1.0 / n_mels)
+    dct = dct.T
+    if cepstral_lifter != 0.0:
+        i = np.arange(n_mfcc, dtype=np.float64)
+        dct *= 1.0 + 0.5 * cepstral_lifter * np.sin(math.pi * i / cepstral_lifter)
+    return _read_only(dct.astype(np.float32))
+
+
+def _get_frames(waveform, window_size, window_shift, dither):
+    """使用snip_edges模式分帧，返回大小为(num_frames, window_size)的帧"""
+    num_samples = waveform.shape[0]
+    if num_samples < window_size:
+        return np.zeros((0, window_size), dtype=np.float32)
+    num_frames = 1 + (num_samples - window_size) // window_shift
+    strides = (window_shift * waveform.strides[0], waveform.strides[0])
+    frames = np.lib.stride_tricks.as_strided(waveform, shape=(num_frames, window_size), strides=strides)
+    frames = frames.astype(np.float32)
+    if dither != 0.0:
+        frames = frames + dither * np.random.standard_normal(frames.shape).astype(np.float32)
+    return frames
+
+
+def fbank(waveform,
+          n_mels=23,
+          frame_length=25,
+          frame_shift=10,
+          dither=0.0,
+          preemph_coeff=0.97,
+          remove_dc_offset=True,
+          round_to_power_of_two=True,
+          low_freq=20.0,
+          high_freq=0.0,
+          sr=16000):
+    """计算与Kaldi兼容的Fbank特征
+
+    :param waveform: 一维的音频数据
+    :type waveform: np.ndarray
+    :param n_mels: Mel滤波器的数量
+    :param frame_length: 帧长，单位毫秒
+    :param frame_shift: 帧移，单位毫秒
+    :param dither: 抖动系数，0表示不加抖动
+    :param preemph_coeff: 预加重系数
+    :param remove_dc_offset: 是否去掉每一帧的直流分量
+    :param round_to_power_of_two: 是否把FFT大小补齐到2的整数次幂
+    :param low_freq: Mel滤波器的最低频率
+    :param high_freq: Mel滤波器的最高频率，小于等于0时表示相对奈奎斯特频率的偏移
+    :param sr: 音频采样率
+    :return: 大小为(num_frames, n_mels)的Fbank特征
+    :rtype: np.ndarray
+    """
+    window_size = int(sr * frame_length * 0.001)
+    window_shift = int(sr * frame_shift * 0.001)
+    padded_window_size = _next_power_of_2(window_size) if round_to_power_of_two else window_size
+    frames = _get_frames(waveform, window_size, window_shift, dither)
+    # 一次矩阵乘法得到所有帧频谱的实部和虚部
+    spectrum = np.matmul(frames, _get_frame_transform(window_size, padded_window_size, preemph_coeff,
+                                                      remove_dc_offset))
+    num_bins = padded_window_size // 2 + 1
+    power_spectrum = np.square(spectrum[:, :num_bins]) + np.square(spectrum[:, num_bins:])
+    mel_energies = np.matmul(power_spectrum, _get_mel_banks(n_mels, padded_window_size, sr, low_freq, high_freq))
+    return np.log(np.maximum(mel_energies, EPSILON))
+
+
+def mfcc(waveform,
+         n_mels=23,
+         n_mfcc=13,
+         frame_length=25,
+         frame_shift=10,
+         dither=0.0,
+         cepstral_lifter=22.0,
+         sr=16000,
+         **kwargs):
+    """计算与Kaldi兼容的MFCC特征
+
+    :param waveform: 一维的音频数据
+    :type waveform: np.ndarray
+    :param n_mels: Mel滤波器的数量
+    :param n_mfcc: MFCC的数量
+    :param frame_length: 帧长，单位毫秒
+    :param frame_shift: 帧移，单位毫秒
+    :param dither: 抖动系数，0表示不加抖动
+    :param cepstral_lifter: 倒谱提升系数，0表示不做倒谱提升
+    :param sr: 音频采样率
+    :param kwargs: 其他计算Fbank的参数
+    :return: 大小为(num_frames, n_mfcc)的MFCC特征
+    :rtype: np.ndarray
+    """
+    assert n_mfcc <= n_mels, f'n_mfcc({n_mfcc})不能大于n_mels({n_mels})'
+    feature = fbank(waveform, n_mels=n_mels, frame_length=frame_length, frame_shift=frame_shift,
+                    dither=dither, sr=sr, **kwargs)
+    return np.matmul(feature, _get_dct_matrix(n_mels, n_mfcc, cepstral_lifter))
@@ -0,0 +1,55 @@
+import numpy as np
+
+from ppasr.data_utils.audio import AudioSegment
+
+
+class OnlineAudioFeaturizer(object):
+    """流式音频特征器，保存不足一帧的尾部音频，每次输入音频只计算新的帧
+
+    因为每一帧的特征只依赖这一帧的音频，所以从下一帧的起点开始计算得到的特征与离线提取完全一致。
+    音量归一化使用到目前为止全部音频的均方根能量，随着音频变长会逐渐接近离线对整段音频归一化的结果。
+
+    :param audio_featurizer: 离线的音频特征器
+    :type audio_featurizer: AudioFeaturizer
+    """
+
+    def __init__(self, audio_featurizer):
+        self._audio_featurizer = audio_featurizer
+        self._frame_length = audio_featurizer.frame_length
+        self._frame_shift = audio_featurizer.frame_shift
+        self._remained_samples = np.zeros((0,), dtype=np.float32)
+        self._sum_square = 0.0
+        self._num_samples = 0
+
+    def featurize(self, audio_segment):
+        """输入新的音频，返回新增帧的特征
+
+        :param audio_segment: 新输入的音频片段
+        :type audio_segment: AudioSegment
+        :return: 新增帧的特征，如果音频还不足一帧，返回帧数为0的特征
+        :rtype: ndarray
+        """
+        featurizer = self._audio_featurizer
+        # upsampling or downsampling
+        if audio_segment.sample_rate != featurizer._target_sample_rate:
+            audio_segment.resample(featurizer._target_sample_rate)
+        new_samples = audio_segment.samples
+        # 累计音频的能量，用于音量归一化
+        self._sum_square += float(np.sum(new_samples.astype(np.float64) ** 2))
+        self._num_samples += len(new_samples)
+        samples = np.concatenate([self._remained_samples, new_samples])
+        # 只计算完整的帧
+        if len(samples) < self._frame_length:
+            self._remained_samples = samples
+            return np.zeros((0, featurizer.feature_dim), dtype=np.float32)
+        num_frames = (len(samples) - self._frame_length) // self._frame_shift + 1
+        used_samples = (num_frames - 1) * self._frame_shift + self._frame_length
+        segment = AudioSegment(samples[:used_samples], featurizer._target_sample_rate)
+        # decibel normalization
+        if featurizer._use_dB_normalization and self._sum_square > 0:
+            rms_db = 10 * np.log10(self._sum_square / self._num_samples)
+            segment.gain_db(min(300.0, featurizer._target_dB - rms_db))
+        feature = featurizer.extract_features(segment)
+        # 保存下一帧开始的音频
+        self._remained_samples = samples[num_frames * self._frame_shift:]
+        return np.array(feature).astype(np.float32)
@@ -341,6 +341,48 @@ def decode_audio(file, sample_rate: int = 16000):
     return audio.astype(np.float32) / 32768.0
 
 
+def decode_audio_blocks(file, sample_rate: int = 16000, block_size: int = 160000):
+    """分块读取音频，不会把整个音频加载到内存中，主要用于长语音识别。
+    优先使用soundfile读取，采样率不一致或者格式不支持时使用PyAV解码并重采样
+
+    Args:
+      file: Path to the input file or a file-like object.
+      sample_rate: Resample the audio to this sample rate.
+      block_size: 每个数据块的大小，单位为采样点
+
+    Returns:
+      A generator of float32 Numpy array.
+    """
+    if isinstance(file, bytes):
+        file = io.BytesIO(file)
+    try:
+        sndfile = soundfile.SoundFile(file)
+    except Exception:
+        sndfile = None
+    if sndfile is not None:
+        if sndfile.samplerate == sample_rate:
+            with sndfile:
+                for block in sndfile.blocks(blocksize=block_size, dtype='float32'):
+                    if block.ndim >= 2:
+                        block = np.mean(block, 1)
+                    yield block
+            return
+        sndfile.close()
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    resampler = av.audio.resampler.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+
+    with av.open(file, metadata_errors="ignore") as container:
+        frames = container.decode(audio=0)
+        frames = _ignore_invalid_frames(frames)
+        frames = _group_frames(frames, block_size)
+        frames = _resample_frames(frames, resampler)
+
+        for frame in frames:
+            # Convert s16 back to f32.
+            yield frame.to_ndarray().reshape(-1).astype(np.float32) / 32768.0
+
+
 def _ignore_invalid_frames(frames):
     iterator = iter(frames)
 
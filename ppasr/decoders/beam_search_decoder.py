@@ -1,9 +1,65 @@
+import copy
 import os
+import threading
 
 from ppasr.decoders.swig_wrapper import Scorer, CTCBeamSearchDecoder
 from ppasr.decoders.swig_wrapper import ctc_beam_search_decoding_batch, ctc_beam_search_decoding
+from ppasr.utils.logger import setup_logger
 from ppasr.utils.utils import download
 
+logger = setup_logger(__name__)
+
+# KenLM二进制语言模型文件的开头
+KENLM_BINARY_MAGIC = b'mmap lm '
+
+# 进程内共享的语言模型，key为(语言模型的绝对路径, 修改时间, 词汇列表)
+_scorer_cache = {}
+_scorer_lock = threading.Lock()
+
+
+def is_binary_lm(language_model_path):
+    """判断是否是KenLM的二进制语言模型，二进制模型使用mmap加载，多个进程可以共享同一份内存页"""
+    with open(language_model_path, 'rb') as f:
+        return f.read(len(KENLM_BINARY_MAGIC)) == KENLM_BINARY_MAGIC
+
+
+def get_scorer(alpha, beta, language_model_path, vocab_list):
+    """获取进程内共享的语言模型，同一个语言模型和词汇列表只加载一次
+
+    语言模型的alpha和beta参数是共享的，解码前需要调用reset_params设置为当前解码器的参数。
+    在创建子进程之前调用，fork出来的子进程也可以直接使用已经加载的语言模型
+
+    :param alpha: 与语言模型相关的参数
+    :param beta: 与字计数相关的参数
+    :param language_model_path: 语言模型的路径
+    :param vocab_list: 词汇列表
+    :return: Scorer
+    """
+    real_path = os.path.realpath(language_model_path)
+    key = (real_path, os.path.getmtime(real_path), tuple(vocab_list))
+    with _scorer_lock:
+        scorer = _scorer_cache.get(key)
+        if scorer is not None:
+            scorer.reset_params(alpha, beta)
+            return scorer
+        if not is_binary_lm(real_path):
+            logger.warning(f'语言模型{language_model_path}不是KenLM二进制格式，每个进程都需要完整加载到内存中，'
+                           f'建议使用KenLM的build_binary工具转换为二进制格式')
+        scorer = Scorer(alpha, beta, real_path, vocab_list)
+        print(f"language model: "
+              f"model path = {language_model_path}, "
+              f"is_character_based = {scorer.is_character_based()}, "
+              f"max_order = {scorer.get_max_order()}, "
+              f"dict_size = {scorer.get_dict_size()}")
+        _scorer_cache[key] = scorer
+        return scorer
+
+
+def clear_scorer_cache():
+    """释放进程内共享的语言模型"""
+    with _scorer_lock:
+        _scorer_cache.clear()
+
 
 class BeamSearchDecoder:
     def __init__(self, alpha, beta, beam_size, cutoff_prob, cutoff_top_n, vocab_list, num_processes=10,
@@ -26,21 +82,19 @@ class BeamSearchDecoder:
         print('=' * 70)
         print("初始化解码器...")
         assert os.path.exists(language_model_path), f'语言模型不存在：{language_model_path}'
-        self._ext_scorer = Scorer(alpha, beta, language_model_path, vocab_list)
-        lm_char_based = self._ext_scorer.is_character_based()
-        lm_max_order = self._ext_scorer.get_max_order()
-        lm_dict_size = self._ext_scorer.get_dict_size()
-        print(f"language model: "
-              f"model path = {language_model_path}, "
-              f"is_character_based = {lm_char_based}, "
-              f"max_order = {lm_max_order}, "
-              f"dict_size = {lm_dict_size}")
+        self._ext_scorer = get_scorer(alpha, beta, language_model_path, vocab_list)
         batch_size = 1
         self.beam_search_decoder = CTCBeamSearchDecoder(vocab_list, batch_size, beam_size, num_processes, cutoff_prob,
                                                         cutoff_top_n, self._ext_scorer, self.blank_id)
         print("初始化解码器完成!")
         print('=' * 70)
 
+    def reset_params(self, alpha, beta):
+        """修改语言模型的alpha和beta参数，不需要重新加载语言模型"""
+        self.alpha = alpha
+        self.beta = beta
+        self._ext_scorer.reset_params(alpha, beta)
+
     # 单个数据解码
     def decode_beam_search_offline(self, probs_split):
         if self._ext_scorer is not None:
@@ -56,19 +110,27 @@ class BeamSearchDecoder:
         return beam_search_result[0]
 
     # 一批数据解码
-    def decode_batch_beam_search_offline(self, probs_split):
+    def decode_batch_beam_search_offline(self, probs_split, return_score=False):
+        """一批数据并行解码
+
+        :param probs_split: 一批模型输出的概率，每条数据的长度可以不同
+        :param return_score: 是否同时返回解码的得分
+        :return: 每条数据的解码结果，return_score为True时每个元素为(得分, 文本)
+        """
         if self._ext_scorer is not None:
             self._ext_scorer.reset_params(self.alpha, self.beta)
         # beam search decode
-        self.num_processes = min(self.num_processes, len(probs_split))
+        num_processes = min(self.num_processes, len(probs_split))
         beam_search_results = ctc_beam_search_decoding_batch(probs_split=probs_split,
                                                              vocabulary=self.vocab_list,
                                                              beam_size=self.beam_size,
-                                                             num_processes=self.num_processes,
+                                                             num_processes=num_processes,
                                                              ext_scoring_func=self._ext_scorer,
                                                              cutoff_prob=self.cutoff_prob,
                                                              cutoff_top_n=self.cutoff_top_n,
                                                              blank_id=self.blank_id)
+        if return_score:
+            return [result[0] for result in beam_search_results]
         results = [result[0][1] for result in beam_search_results]
         return results
 
@@ -79,17 +141,43 @@ class BeamSearchDecoder:
             probs (list(list(float))):一个batch模型输入的结构
             logits_lens (list(int)): 一个batch模型输出的长度
         """
+        self.feed_chunk(probs=probs, logits_lens=logits_lens)
+        return self.get_chunk_result()
+
+    def feed_chunk(self, probs, logits_lens):
+        """把一个数据块的输出输入到流式解码器，不获取解码结果，连续多个数据块只需要在最后获取一次结果
+
+        Args:
+            probs (numpy.ndarray): 一个batch模型输出的概率
+            logits_lens (numpy.ndarray): 一个batch模型输出的长度
+        """
+        # 语言模型是多个解码器共享的，需要使用当前解码器的参数
+        self._ext_scorer.reset_params(self.alpha, self.beta)
         has_value = (logits_lens > 0).tolist()
         has_value = ["true" if has_value[i] is True else "false" for i in range(len(has_value))]
         probs_split = [probs[i, :l, :].tolist() if has_value[i] else probs[i].tolist()
                        for i, l in enumerate(logits_lens)]
         self.beam_search_decoder.next(probs_split, has_value)
 
+    def get_chunk_result(self):
+        """获取流式解码器目前最优的解码结果"""
         batch_beam_results = self.beam_search_decoder.decode()
         batch_beam_results = [[(res[0], res[1]) for res in beam_results] for beam_results in batch_beam_results]
         results_best = [result for result in batch_beam_results]
         return results_best[0][0]
 
+    def create_stream_decoder(self):
+        """创建一个新的流式解码器，与当前解码器共享语言模型，用于多个流式会话各自保存解码状态"""
+        batch_size = 1
+        return CTCBeamSearchDecoder(self.vocab_list, batch_size, self.beam_size, self.num_processes, self.cutoff_prob,
+                                    self.cutoff_top_n, self._ext_scorer, self.blank_id)
+
+    def clone(self):
+        """复制一个解码器，与当前解码器共享语言模型，流式解码的状态是独立的"""
+        decoder = copy.copy(self)
+        decoder.beam_search_decoder = self.create_stream_decoder()
+        return decoder
+
     def reset_decoder(self):
         batch_size = 1
         self.beam_search_decoder.reset_state(batch_size, self.beam_size, self.num_processes,
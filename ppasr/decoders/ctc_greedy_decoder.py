@@ -1,5 +1,3 @@
-from itertools import groupby
-
 import numpy as np
 
 
@@ -17,39 +15,82 @@ def greedy_decoder(probs_seq, vocabulary, blank_index=0):
     :return: 解码后得到的字符串
     :rtype: baseline
     """
-    # 获得每个时间步的最佳索引
-    max_index_list = list(np.array(probs_seq).argmax(axis=1))
-    max_prob_list = [probs_seq[i][max_index_list[i]] for i in range(len(max_index_list)) if max_index_list[i] != blank_index]
-    # 删除连续的重复索引和空索引
-    index_list = [index_group[0] for index_group in groupby(max_index_list)]
-    index_list = [index for index in index_list if index != blank_index]
-    # 索引列表转换为字符串
-    text = ''.join([vocabulary[index] for index in index_list])
-    score = 0
-    if len(max_prob_list) > 0:
-        score = float(sum(max_prob_list) / len(max_prob_list)) * 100.0
-    return score, text.replace('<space>', ' ')
+    scores, texts = greedy_decoder_batch([probs_seq], vocabulary, blank_index=blank_index, return_score=True)
+    return scores[0], texts[0]
 
 
-def greedy_decoder_batch(probs_split, vocabulary, blank_index=0):
-    """CTC贪婪(最佳路径)解码器
-    :param probs_split: 一批包含2D的概率表
-    :type probs_split: list
+def greedy_decoder_batch(probs_split, vocabulary, blank_index=0, probs_lens=None, return_score=False):
+    """CTC贪婪(最佳路径)批量解码器，整个批量使用向量化计算，不需要逐帧处理
+
+    :param probs_split: 一批包含2D的概率表，可以是[B, T, V]的数组，也可以是长度不一的2D概率表列表
+    :type probs_split: numpy.ndarray|list
     :param vocabulary: 词汇列表
     :type vocabulary: list
     :param blank_index 需要移除的空白索引
     :type blank_index int
-    :return: 字符串列表
+    :param probs_lens: 每条数据有效的帧数，为None时使用全部的帧
+    :type probs_lens: numpy.ndarray|list
+    :param return_score: 是否同时返回解码得分
+    :type return_score: bool
+    :return: 字符串列表，如果return_score为True，返回得分列表和字符串列表
     :rtype: list
     """
-    results = []
-    for i, probs in enumerate(probs_split):
-        output_transcription = greedy_decoder(probs, vocabulary, blank_index=blank_index)
-        results.append(output_transcription[1])
-    return results
+    if len(probs_split) == 0:
+        return ([], []) if return_score else []
+    if isinstance(probs_split, np.ndarray) and probs_split.ndim == 3:
+        probs = probs_split
+        if probs_lens is None:
+            probs_lens = np.full((probs.shape[0],), probs.shape[1], dtype=np.int64)
+    else:
+        # 长度不一的数据填充为一个批量
+        if probs_lens is None:
+            probs_lens = [len(p) for p in probs_split]
+        max_len = max(max(probs_lens), 1)
+        probs = np.zeros((len(probs_split), max_len, len(vocabulary)), dtype=np.float32)
+        for i, p in enumerate(probs_split):
+            probs[i, :probs_lens[i]] = np.asarray(p)[:probs_lens[i]]
+    probs_lens = np.asarray(probs_lens)
+    batch_size, max_len = probs.shape[0], probs.shape[1]
+    # 获得每个时间步的最佳索引和概率
+    max_index = probs.argmax(axis=2)
+    max_prob = np.take_along_axis(probs, max_index[:, :, np.newaxis], axis=2)[:, :, 0]
+    # 有效的非空白帧
+    non_blank = (max_index != blank_index) & (np.arange(max_len)[np.newaxis, :] < probs_lens[:, np.newaxis])
+    # 删除连续的重复索引和空索引
+    keep = non_blank.copy()
+    keep[:, 1:] &= max_index[:, 1:] != max_index[:, :-1]
+    # 得分为非空白帧的平均概率
+    num_non_blank = non_blank.sum(axis=1)
+    scores = np.where(num_non_blank > 0,
+                      (max_prob * non_blank).sum(axis=1) / np.maximum(num_non_blank, 1) * 100.0, 0.0)
+    # 索引列表转换为字符串
+    rows, cols = np.nonzero(keep)
+    tokens = np.asarray(vocabulary, dtype=object)[max_index[rows, cols]]
+    splits = np.cumsum(np.bincount(rows, minlength=batch_size))[:-1]
+    texts = [''.join(t).replace('<space>', ' ') for t in np.split(tokens, splits)]
+    if return_score:
+        return [float(score) for score in scores], texts
+    return texts
+
 
+class GreedyChunkState(object):
+    """CTC贪婪流式解码的状态，只保存上一帧的索引、累计得分和已经解码的结果，每次解码的计算量只与当前数据块有关"""
+    __slots__ = ('last_index', 'score_sum', 'score_count', 'text')
 
-def greedy_decoder_chunk(probs_seq, vocabulary, last_max_prob_list=None, last_max_index_list=None, blank_index=0):
+    def __init__(self):
+        self.last_index = -1
+        self.score_sum = 0.0
+        self.score_count = 0
+        self.text = ''
+
+    @property
+    def score(self):
+        if self.score_count == 0:
+            return 0
+        return self.score_sum / self.score_count * 100.0
+
+
+def greedy_decoder_chunk(probs_seq, vocabulary, state=None, blank_index=0):
     """CTC贪婪(最佳路径)流式解码器
 
     由最可能的令牌组成的路径将被进一步后处理到去掉连续重复和所有空白
@@ -58,32 +99,29 @@ def greedy_decoder_chunk(probs_seq, vocabulary, last_max_prob_list=None, last_ma
     :type probs_seq: numpy.ndarray
     :param vocabulary: 词汇列表
     :type vocabulary: list
-    :param last_max_prob_list 上次解码的最大索引
-    :type last_max_prob_list list
-    :param last_max_index_list 上次解码得分
-    :type last_max_index_list list
+    :param state: 上一个数据块解码之后的状态，为None时表示第一个数据块
+    :type state: GreedyChunkState
     :param blank_index 需要移除的空白索引
     :type blank_index int
-    :return: 解码后得到的字符串
-    :rtype: baseline
+    :return: 解码得分，到目前为止解码得到的字符串和更新后的状态
+    :rtype: tuple
     """
-    # 获得每个时间步的最佳索引
-    if last_max_prob_list is None:
-        last_max_prob_list = []
-    if last_max_index_list is None:
-        last_max_index_list = []
-    max_index_list = list(np.array(probs_seq).argmax(axis=1))
-    max_prob_list = [probs_seq[i][max_index_list[i]] for i in range(len(max_index_list)) if max_index_list[i] != blank_index]
-    # 加入之前的结果
-    last_max_prob_list.extend(max_index_list)
-    last_max_index_list.extend(max_prob_list)
-
-    # 删除连续的重复索引和空索引
-    index_list = [index_group[0] for index_group in groupby(last_max_prob_list)]
-    index_list = [index for index in index_list if index != blank_index]
-    # 索引列表转换为字符串
-    text = ''.join([vocabulary[index] for index in index_list])
-    score = 0
-    if len(last_max_index_list) > 0:
-        score = float(sum(last_max_index_list) / len(last_max_index_list)) * 100.0
-    return score, text.replace('<space>', ' '), last_max_prob_list, last_max_index_list
+    if state is None:
+        state = GreedyChunkState()
+    probs_seq = np.asarray(probs_seq)
+    if len(probs_seq) == 0:
+        return state.score, state.text, state
+    # 获得每个时间步的最佳索引和概率
+    max_index = probs_seq.argmax(axis=1)
+    max_prob = probs_seq[np.arange(len(max_index)), max_index]
+    non_blank = max_index != blank_index
+    state.score_sum += float(max_prob[non_blank].sum())
+    state.score_count += int(non_blank.sum())
+    # 删除连续的重复索引和空索引，第一帧需要与上一个数据块的最后一帧比较
+    prev_index = np.concatenate([[state.last_index], max_index[:-1]])
+    new_tokens = max_index[non_blank & (max_index != prev_index)].tolist()
+    state.last_index = int(max_index[-1])
+    # 只有解码出新的字时才追加到结果中，没有新的字时结果保持不变
+    if len(new_tokens) > 0:
+        state.text += ''.join([vocabulary[index] for index in new_tokens]).replace('<space>', ' ')
+    return state.score, state.text, state
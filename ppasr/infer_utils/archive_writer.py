@@ -0,0 +1,176 @@
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import soundfile
+
+from ppasr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+__all__ = ['ArchiveWriter']
+
+# 支持的压缩格式，对应soundfile的格式、编码和文件后缀
+ARCHIVE_FORMATS = {'wav': ('WAV', 'PCM_16', '.wav'),
+                   'flac': ('FLAC', 'PCM_16', '.flac'),
+                   'opus': ('OGG', 'OPUS', '.opus')}
+
+
+class ArchiveWriter(object):
+    def __init__(self, save_path, audio_format='wav', max_queue_size=100, max_days=0, max_size_mb=0,
+                 max_batch_size=32):
+        """
+        后台音频归档工具，使用一个后台线程和有界队列保存音频，保存音频不会阻塞调用者，
+        后台线程每次取出队列中全部等待保存的音频一起写入，音频按日期保存在不同的文件夹中，
+        并且定期删除超过保留期限或者总大小限制的旧文件
+
+        :param save_path: 音频保存的根目录
+        :param audio_format: 录音保存的格式，支持：wav、flac、opus
+        :param max_queue_size: 等待保存的音频最大数量，队列满时丢弃新的音频，不会阻塞调用者
+        :param max_days: 音频保留的天数，为0时不删除
+        :param max_size_mb: 全部音频最大的总大小，单位MB，为0时不限制
+        :param max_batch_size: 每次最多一起写入的音频数量
+        """
+        if audio_format not in ARCHIVE_FORMATS:
+            raise Exception(f'不支持该音频格式：{audio_format}，支持的格式有：{list(ARCHIVE_FORMATS.keys())}')
+        self.save_path = save_path
+        self.audio_format = audio_format
+        self.max_days = max_days
+        self.max_size = max_size_mb * 1024 * 1024
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._last_cleanup = 0
+        self._num_dropped = 0
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def queue_depth(self):
+        """等待保存的音频数量"""
+        return self._queue.qsize()
+
+    def stats(self):
+        return {'queue_depth': self.queue_depth, 'num_dropped': self._num_dropped}
+
+    def archive_pcm(self, pcm_bytes, sample_rate=16000):
+        """保存16位单声道PCM录音，按照指定的格式压缩
+
+        :param pcm_bytes: 16位单声道PCM字节
+        :param sample_rate: 录音的采样率
+        :return: 是否成功加入保存队列
+        """
+        if len(pcm_bytes) == 0: return False
+        return self._put(('pcm', pcm_bytes, sample_rate))
+
+    def archive_file(self, data, suffix):
+        """保存上传的音频文件，不重新编码
+
+        :param data: 音频文件的字节
+        :param suffix: 文件后缀，例如：.wav
+        :return: 是否成功加入保存队列
+        """
+        if len(data) == 0: return False
+        return self._put(('file', data, suffix))
+
+    def close(self):
+        """保存完队列中的音频之后结束后台线程"""
+        self._queue.put(None)
+        self._worker.join()
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            self._num_dropped += 1
+            logger.warning(f'音频保存队列已满，丢弃该音频，已丢弃{self._num_dropped}条')
+            return False
+
+    @staticmethod
+    def _new_path(save_dir, suffix):
+        timestamp = int(time.time() * 1000)
+        # 同一毫秒内保存多条音频时避免覆盖
+        while os.path.exists(os.path.join(save_dir, f'{timestamp}{suffix}')):
+            timestamp += 1
+        return os.path.join(save_dir, f'{timestamp}{suffix}')
+
+    def _next_batch(self):
+        """等待第一条音频，然后取出队列中已经在等待的音频，最多max_batch_size条，遇到结束标志时返回is_closed为True"""
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch_size and batch[-1] is not None:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            return batch[:-1], True
+        return batch, False
+
+    def _write_batch(self, batch):
+        """一起写入一批音频，同一批音频只需要创建一次日期文件夹"""
+        save_dir = os.path.join(self.save_path, datetime.now().strftime('%Y-%m-%d'))
+        os.makedirs(save_dir, exist_ok=True)
+        file_format, subtype, pcm_suffix = ARCHIVE_FORMATS[self.audio_format]
+        for kind, data, arg in batch:
+            try:
+                if kind == 'pcm':
+                    samples = np.frombuffer(data, dtype=np.int16)
+                    soundfile.write(self._new_path(save_dir, pcm_suffix), samples, arg,
+                                    format=file_format, subtype=subtype)
+                else:
+                    with open(self._new_path(save_dir, arg), 'wb') as f:
+                        f.write(data)
+            except Exception as e:
+                logger.error(f'保存音频失败，错误信息：{e}')
+
+    def _run(self):
+        while True:
+            batch, is_closed = self._next_batch()
+            if len(batch) > 0:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    logger.error(f'保存音频失败，错误信息：{e}')
+            if is_closed: return
+            # 每分钟最多清理一次旧文件
+            if time.time() - self._last_cleanup > 60:
+                self._last_cleanup = time.time()
+                try:
+                    self._cleanup()
+                except Exception as e:
+                    logger.error(f'清理旧音频失败，错误信息：{e}')
+
+    def _cleanup(self):
+        day_dirs = []
+        for name in sorted(os.listdir(self.save_path)):
+            path = os.path.join(self.save_path, name)
+            try:
+                day = datetime.strptime(name, '%Y-%m-%d')
+            except ValueError:
+                continue
+            if os.path.isdir(path):
+                day_dirs.append((day, path))
+        # 删除超过保留天数的文件夹
+        if self.max_days > 0:
+            expire_day = datetime.now() - timedelta(days=self.max_days)
+            for day, path in day_dirs:
+                if day < expire_day:
+                    shutil.rmtree(path, ignore_errors=True)
+                    logger.info(f'删除超过保留期限的音频：{path}')
+            day_dirs = [(day, path) for day, path in day_dirs if day >= expire_day]
+        # 总大小超过限制时从最旧的文件开始删除
+        if self.max_size > 0:
+            files = []
+            for _, path in day_dirs:
+                for name in sorted(os.listdir(path)):
+                    file_path = os.path.join(path, name)
+                    files.append((file_path, os.path.getsize(file_path)))
+            total_size = sum(size for _, size in files)
+            for file_path, size in files:
+                if total_size <= self.max_size: break
+                os.remove(file_path)
+                total_size -= size
@@ -0,0 +1,149 @@
+import bisect
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from ppasr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+__all__ = ['BatchScheduler']
+
+
+class _Request(object):
+    __slots__ = ('audio_segment', 'future', 'enqueue_time')
+
+    def __init__(self, audio_segment):
+        self.audio_segment = audio_segment
+        self.future = Future()
+        self.enqueue_time = time.time()
+
+
+class BatchScheduler(object):
+    def __init__(self,
+                 predictors,
+                 max_batch_size=16,
+                 max_wait_ms=10,
+                 bucket_boundaries=(2, 5, 10, 20),
+                 use_pun=False,
+                 is_itn=False):
+        """
+        动态批量调度器，把一段时间内的识别请求按音频长度分桶，合并成一个批量执行推理，
+        每个预测器由一个工作线程负责，多个工作线程从同一个队列中获取批量，模型不支持批量推理时也可以并发识别
+
+        :param predictors: 执行批量推理的PPASRPredictor列表，每个预测器对应一个工作线程
+        :param max_batch_size: 每个批量最多包含的请求数量
+        :param max_wait_ms: 请求在队列中最多等待的时间，单位毫秒，超过之后不管批量是否已满都会执行推理
+        :param bucket_boundaries: 分桶的音频长度边界，单位秒，长度相近的音频才会合并到同一个批量
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        """
+        assert len(predictors) >= 1, '至少需要一个预测器'
+        assert max_batch_size >= 1, f'批量大小必须大于等于1，当前为：{max_batch_size}'
+        self.predictors = predictors
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_boundaries = sorted(bucket_boundaries)
+        self.use_pun = use_pun
+        self.is_itn = is_itn
+        self._buckets = [deque() for _ in range(len(self.bucket_boundaries) + 1)]
+        self._cond = threading.Condition()
+        self._closed = False
+        # 统计信息
+        self._num_requests = 0
+        self._num_batches = 0
+        self._max_queue_depth = 0
+        self._total_wait = 0.0
+        self._workers = []
+        for predictor in predictors:
+            worker = threading.Thread(target=self._run, args=(predictor,), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, audio_data, sample_rate=16000):
+        """提交一个识别请求
+
+        :param audio_data: 需要识别的数据，支持文件路径，文件对象，字节，numpy，AudioSegment
+        :param sample_rate: 如果传入的事numpy数据，需要指定采样率
+        :return: 识别结果的Future，结果与PPASRPredictor.predict()一致
+        """
+        audio_segment = self.predictors[0]._load_audio(audio_data=audio_data, sample_rate=sample_rate)
+        request = _Request(audio_segment)
+        bucket_id = bisect.bisect_left(self.bucket_boundaries, audio_segment.duration)
+        with self._cond:
+            if self._closed:
+                raise Exception('批量调度器已关闭')
+            self._buckets[bucket_id].append(request)
+            self._num_requests += 1
+            self._max_queue_depth = max(self._max_queue_depth, self.queue_depth)
+            self._cond.notify()
+        return request.future
+
+    @property
+    def queue_depth(self):
+        """当前排队的请求数量"""
+        return sum(len(bucket) for bucket in self._buckets)
+
+    def stats(self):
+        """获取队列的统计信息"""
+        with self._cond:
+            return {'num_workers': len(self._workers),
+                    'queue_depth': self.queue_depth,
+                    'bucket_depths': [len(bucket) for bucket in self._buckets],
+                    'max_queue_depth': self._max_queue_depth,
+                    'num_requests': self._num_requests,
+                    'num_batches': self._num_batches,
+                    'avg_batch_size': round(self._num_requests / max(self._num_batches, 1), 2),
+                    'avg_wait_ms': round(self._total_wait * 1000 / max(self._num_requests, 1), 2)}
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    # 选择一个可以执行的批量，没有的话返回需要等待的时间
+    def _next_batch(self):
+        now = time.time()
+        oldest_bucket, oldest_time = None, None
+        for bucket in self._buckets:
+            if len(bucket) == 0: continue
+            if len(bucket) >= self.max_batch_size:
+                return [bucket.popleft() for _ in range(self.max_batch_size)], None
+            if oldest_time is None or bucket[0].enqueue_time < oldest_time:
+                oldest_bucket, oldest_time = bucket, bucket[0].enqueue_time
+        if oldest_bucket is None:
+            return None, None
+        wait_time = oldest_time + self.max_wait - now
+        if wait_time <= 0 or self._closed:
+            return [oldest_bucket.popleft() for _ in range(len(oldest_bucket))], None
+        return None, wait_time
+
+    def _run(self, predictor):
+        while True:
+            with self._cond:
+                batch, wait_time = self._next_batch()
+                while batch is None:
+                    if self._closed and self.queue_depth == 0:
+                        return
+                    self._cond.wait(timeout=wait_time)
+                    batch, wait_time = self._next_batch()
+                self._num_batches += 1
+                now = time.time()
+                self._total_wait += sum(now - r.enqueue_time for r in batch)
+            # 已经被取消的请求（例如请求超时）不需要再识别
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            if len(batch) == 0: continue
+            try:
+                results = predictor.predict_batch(audios_data=[r.audio_segment for r in batch],
+                                                  use_pun=self.use_pun,
+                                                  is_itn=self.is_itn,
+                                                  batch_size=self.max_batch_size)
+                for request, result in zip(batch, results):
+                    request.future.set_result(result)
+            except Exception as e:
+                logger.error(f'批量识别失败，错误信息：{e}')
+                for request in batch:
+                    request.future.set_exception(e)
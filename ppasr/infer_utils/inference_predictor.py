@@ -1,4 +1,8 @@
+import copy
+import hashlib
+import json
 import os
+import shutil
 
 import numpy as np
 import paddle.inference as paddle_infer
@@ -8,6 +12,48 @@ from ppasr.utils.logger import setup_logger
 logger = setup_logger(__name__)
 
 
+# 保存的IR优化之后的模型文件名
+OPTIM_MODEL_NAME = '_optimized.pdmodel'
+OPTIM_PARAMS_NAME = '_optimized.pdiparams'
+
+
+def get_optim_cache_path(optim_cache_dir, model_path, params_path, **flags):
+    """获取IR优化之后的模型的缓存文件夹，由模型文件的路径、大小和修改时间、Paddle版本和创建预测器的参数共同决定，
+    不需要读取整个模型文件，启动时几乎没有额外的耗时
+
+    :param optim_cache_dir: 缓存的根目录
+    :param model_path: 模型结构文件路径
+    :param params_path: 模型参数文件路径
+    :param flags: 影响IR优化结果的参数，例如是否使用GPU
+    :return: 缓存文件夹路径
+    """
+    key = {'paddle_version': paddle_infer.get_version(), 'flags': flags}
+    for name, path in [('model', model_path), ('params', params_path)]:
+        stat = os.stat(path)
+        key[name] = [os.path.realpath(path), stat.st_size, stat.st_mtime_ns]
+    md5 = hashlib.md5(json.dumps(key, sort_keys=True).encode('utf-8'))
+    return os.path.join(optim_cache_dir, md5.hexdigest())
+
+
+class StreamState(object):
+    """流式识别的状态，与预测器分离，一个预测器可以轮流服务多个会话
+
+    :param offset: Conformer类模型当前编码器输出的偏移量
+    :param att_cache: Conformer类模型注意力层的缓存
+    :param cnn_cache: Conformer类模型卷积层的缓存
+    :param output_state_h: DeepSpeech2模型RNN的隐藏状态
+    :param output_state_c: DeepSpeech2模型RNN的细胞状态
+    """
+    __slots__ = ('offset', 'att_cache', 'cnn_cache', 'output_state_h', 'output_state_c')
+
+    def __init__(self, offset=0, att_cache=None, cnn_cache=None, output_state_h=None, output_state_c=None):
+        self.offset = offset
+        self.att_cache = np.zeros([0, 0, 0, 0], dtype=np.float32) if att_cache is None else att_cache
+        self.cnn_cache = np.zeros([0, 0, 0, 0], dtype=np.float32) if cnn_cache is None else cnn_cache
+        self.output_state_h = output_state_h
+        self.output_state_c = output_state_c
+
+
 class InferencePredictor:
     def __init__(self,
                  configs,
@@ -17,7 +63,8 @@ class InferencePredictor:
                  use_gpu=True,
                  use_tensorrt=False,
                  gpu_mem=1000,
-                 num_threads=10):
+                 num_threads=10,
+                 optim_cache_dir=None):
         """
         语音识别预测工具
         :param configs: 配置参数
@@ -25,23 +72,36 @@ class InferencePredictor:
         :param use_model: 是否为流式模型
         :param model_dir: 导出的预测模型文件夹路径
         :param use_gpu: 是否使用GPU预测
+        :param use_tensorrt: 是否使用TensorRT，需要先收集输入的形状范围
         :param gpu_mem: 预先分配的GPU显存大小
         :param num_threads: 只用CPU预测的线程数量
+        :param optim_cache_dir: 保存IR优化之后的模型的文件夹，之后启动时直接加载，不需要重新执行IR优化，为None时不使用
         """
         self.configs = configs
         self.use_model = use_model
         self.streaming = streaming
         # 流式参数
-        self.output_state_h = None
-        self.output_state_c = None
-        self.cnn_cache = np.zeros([0, 0, 0, 0], dtype=np.float32)
-        self.att_cache = np.zeros([0, 0, 0, 0], dtype=np.float32)
-        self.offset = np.array([0], dtype=np.int32)
+        self.stream_state = StreamState()
         # 创建 config
         model_path = os.path.join(model_dir, 'model.pdmodel')
         params_path = os.path.join(model_dir, 'model.pdiparams')
         if not os.path.exists(model_path) or not os.path.exists(params_path):
             raise Exception("模型文件不存在，请检查%s和%s是否存在！" % (model_path, params_path))
+        # 使用缓存的IR优化之后的模型，TensorRT引擎有自己的序列化，不使用缓存
+        ir_optim, save_optim_path = True, None
+        if optim_cache_dir is not None and not use_tensorrt:
+            # 与下面创建config时的设置保持一致，这些设置都会改变IR优化之后的模型
+            cache_path = get_optim_cache_path(optim_cache_dir, model_path, params_path, use_model=use_model,
+                                              streaming=streaming, use_gpu=use_gpu, gpu_id=0, use_mkldnn=False,
+                                              memory_optim=True, use_feed_fetch_ops=False)
+            if os.path.exists(os.path.join(cache_path, OPTIM_MODEL_NAME)) and \
+                    os.path.exists(os.path.join(cache_path, OPTIM_PARAMS_NAME)):
+                model_path = os.path.join(cache_path, OPTIM_MODEL_NAME)
+                params_path = os.path.join(cache_path, OPTIM_PARAMS_NAME)
+                ir_optim = False
+                logger.info(f'使用缓存的IR优化模型：{cache_path}')
+            else:
+                save_optim_path = cache_path
         config = paddle_infer.Config(model_path, params_path)
 
         if use_gpu:
@@ -50,16 +110,20 @@ class InferencePredictor:
             if use_tensorrt:
                 shape_file = f"{model_dir}/shape_range_info.pbtxt"
                 if not os.path.exists(shape_file):
+                    # 没有形状范围时不能使用动态形状的TensorRT，这次只收集预热和识别时各个输入的形状范围，
+                    # 预测器销毁时保存，下次启动才使用TensorRT
                     config.collect_shape_range_info(shape_file)
-                config.enable_tensorrt_engine(workspace_size=1 << 30,
-                                              max_batch_size=1,
-                                              min_subgraph_size=3,
-                                              precision_mode=paddle_infer.PrecisionType.Float32,
-                                              use_static=False,
-                                              use_calib_mode=False)
-                if os.path.exists(shape_file):
+                    logger.warning(f'形状范围文件不存在，这次启动只收集形状范围，退出时保存到：{shape_file}，'
+                                   f'下次启动才使用TensorRT')
+                else:
+                    config.enable_tensorrt_engine(workspace_size=1 << 30,
+                                                  max_batch_size=1,
+                                                  min_subgraph_size=3,
+                                                  precision_mode=paddle_infer.PrecisionType.Float32,
+                                                  use_static=False,
+                                                  use_calib_mode=False)
                     config.enable_tuned_tensorrt_dynamic_shape(shape_file, True)
-                config.exp_disable_tensorrt_ops(["Concat", "reshape2"])
+                    config.exp_disable_tensorrt_ops(["Concat", "reshape2"])
         else:
             config.disable_gpu()
             # 存在精度损失问题
@@ -69,13 +133,40 @@ class InferencePredictor:
         config.disable_glog_info()
         # enable memory optim
         config.enable_memory_optim()
-        config.switch_ir_optim(True)
+        config.switch_ir_optim(ir_optim)
         config.switch_use_feed_fetch_ops(False)
+        # 先保存到临时文件夹，完成之后再改名，多个进程同时启动时不会读取到不完整的模型
+        tmp_optim_path = None
+        if save_optim_path is not None:
+            if hasattr(config, 'enable_save_optim_model'):
+                tmp_optim_path = f'{save_optim_path}.tmp{os.getpid()}'
+                os.makedirs(tmp_optim_path, exist_ok=True)
+                config.set_optim_cache_dir(tmp_optim_path)
+                config.enable_save_optim_model(True)
+            else:
+                logger.warning('当前的PaddlePaddle版本不支持保存IR优化之后的模型，请升级PaddlePaddle')
 
         # 根据 config 创建 predictor
         self.predictor = paddle_infer.create_predictor(config)
+        if tmp_optim_path is not None:
+            self._save_optim_model(tmp_optim_path, save_optim_path)
         logger.info(f'已加载模型：{model_dir}')
+        self._init_handles()
+
+    @staticmethod
+    def _save_optim_model(tmp_optim_path, save_optim_path):
+        try:
+            if os.path.exists(os.path.join(tmp_optim_path, OPTIM_MODEL_NAME)) and \
+                    os.path.exists(os.path.join(tmp_optim_path, OPTIM_PARAMS_NAME)) and \
+                    not os.path.exists(save_optim_path):
+                os.replace(tmp_optim_path, save_optim_path)
+                logger.info(f'已保存IR优化之后的模型：{save_optim_path}')
+        except OSError as e:
+            logger.warning(f'保存IR优化之后的模型失败，错误信息：{e}')
+        shutil.rmtree(tmp_optim_path, ignore_errors=True)
 
+    # 获取输入层和输出的名称
+    def _init_handles(self):
         # 获取输入层
         self.speech_data_handle = self.predictor.get_input_handle('speech')
         # deepspeech2模型
@@ -99,6 +190,56 @@ class InferencePredictor:
         # 获取输出的名称
         self.output_names = self.predictor.get_output_names()
 
+    def clone(self):
+        """复制一个预测器，新的预测器与当前预测器共享模型权重，只有自己的输入输出和中间结果，可以在另一个线程中使用
+
+        :return: 新的InferencePredictor
+        """
+        predictor = copy.copy(self)
+        predictor.predictor = self.predictor.clone()
+        predictor.stream_state = StreamState()
+        predictor._init_handles()
+        return predictor
+
+    @property
+    def support_batch(self):
+        """导出的模型是否支持批量输入，流式的Conformer类模型导出时固定了batch为1"""
+        return not ('former' in self.use_model and self.streaming)
+
+    def get_output_lens(self, speech_lengths):
+        """根据模型的降采样结构计算每条数据有效的输出长度，与模型中掩码的计算方式一致
+
+        :param speech_lengths: 每条数据输入特征的长度
+        :return: 每条数据有效的输出长度
+        """
+        lens = np.asarray(speech_lengths).astype(np.int64)
+        encoder_conf = self.configs.get('encoder_conf', None) or {}
+        input_layer = encoder_conf.get('input_layer', 'conv2d')
+        if self.use_model == 'deepspeech2' or self.use_model == 'squeezeformer' or input_layer == 'conv2d':
+            lens = ((lens - 1) // 2 - 1) // 2
+        elif input_layer == 'conv2d2':
+            lens = (lens - 1) // 2
+        elif input_layer == 'conv2d6':
+            lens = ((lens - 1) // 2 - 2) // 3
+        elif input_layer == 'conv2d8':
+            lens = (((lens - 1) // 2 - 1) // 2 - 1) // 2
+        elif input_layer != 'linear':
+            raise Exception(f'不支持该输入层：{input_layer}')
+        # Efficient Conformer中间的降采样层
+        if self.use_model == 'efficient_conformer':
+            efficient_conf = encoder_conf.get('efficient_conf', None) or {}
+            strides = efficient_conf.get('stride', [2])
+            for stride in [strides] if isinstance(strides, int) else strides:
+                lens = (lens + stride - 1) // stride
+        # Squeezeformer中间的降采样层，没有恢复长度时输出长度减半
+        if self.use_model == 'squeezeformer':
+            reduce_idx = encoder_conf.get('reduce_idx', 5)
+            recover_idx = encoder_conf.get('recover_idx', 11)
+            if reduce_idx is not None and recover_idx is None:
+                for _ in [reduce_idx] if isinstance(reduce_idx, int) else reduce_idx:
+                    lens = (lens + 1) // 2
+        return np.maximum(lens, 0)
+
     # 预测音频
     def predict(self, speech, speech_lengths):
         """
@@ -125,16 +266,7 @@ class InferencePredictor:
             self.init_state_c_box_handle.copy_from_cpu(init_state_h_box)
         # 对流式conformer模型全零初始化
         if 'former' in self.use_model and self.streaming:
-            self.reset_stream()
-            self.offset_handle.reshape(self.offset.shape)
-            self.offset_handle.copy_from_cpu(self.offset)
-            required_cache_size = np.array([-1], dtype=np.int32)
-            self.required_cache_size_handle.reshape(required_cache_size.shape)
-            self.required_cache_size_handle.copy_from_cpu(required_cache_size)
-            self.cnn_cache_handle.reshape(self.cnn_cache.shape)
-            self.cnn_cache_handle.copy_from_cpu(self.cnn_cache)
-            self.att_cache_handle.reshape(self.att_cache.shape)
-            self.att_cache_handle.copy_from_cpu(self.att_cache)
+            self._set_conformer_state(StreamState(), required_cache_size=-1)
 
         # 运行predictor
         self.predictor.run()
@@ -145,6 +277,17 @@ class InferencePredictor:
         return output_data
 
     def predict_chunk_deepspeech(self, x_chunk):
+        output_chunk_probs, output_lens, self.stream_state = \
+            self.predict_chunk_deepspeech_state(x_chunk=x_chunk, state=self.stream_state)
+        return output_chunk_probs, output_lens
+
+    def predict_chunk_deepspeech_state(self, x_chunk, state):
+        """使用指定的流式状态预测一个DeepSpeech2模型的数据块
+
+        :param x_chunk: 数据块的特征
+        :param state: 这个会话的流式状态StreamState
+        :return: 数据块的输出概率，输出长度和更新后的流式状态
+        """
         if not (self.use_model == 'deepspeech2' and self.streaming):
             raise Exception(f'当前模型不支持该方法，当前模型为：{self.use_model}')
         # 设置输入
@@ -154,18 +297,19 @@ class InferencePredictor:
         self.speech_data_handle.copy_from_cpu(x_chunk.astype(np.float32))
         self.speech_lengths_handle.copy_from_cpu(x_chunk_lens.astype(np.int64))
 
-        if self.output_state_h is None:
+        output_state_h, output_state_c = state.output_state_h, state.output_state_c
+        if output_state_h is None:
             # 全零初始化
-            self.output_state_h = np.zeros(shape=(self.configs.encoder_conf.num_rnn_layers,
-                                                  x_chunk.shape[0],
-                                                  self.configs.encoder_conf.rnn_size), dtype=np.float32)
-            self.output_state_c = np.zeros(shape=(self.configs.encoder_conf.num_rnn_layers,
-                                                  x_chunk.shape[0],
-                                                  self.configs.encoder_conf.rnn_size), dtype=np.float32)
-        self.init_state_h_box_handle.reshape(self.output_state_h.shape)
-        self.init_state_h_box_handle.copy_from_cpu(self.output_state_h)
-        self.init_state_c_box_handle.reshape(self.output_state_c.shape)
-        self.init_state_c_box_handle.copy_from_cpu(self.output_state_c)
+            output_state_h = np.zeros(shape=(self.configs.encoder_conf.num_rnn_layers,
+                                             x_chunk.shape[0],
+                                             self.configs.encoder_conf.rnn_size), dtype=np.float32)
+            output_state_c = np.zeros(shape=(self.configs.encoder_conf.num_rnn_layers,
+                                             x_chunk.shape[0],
+                                             self.configs.encoder_conf.rnn_size), dtype=np.float32)
+        self.init_state_h_box_handle.reshape(output_state_h.shape)
+        self.init_state_h_box_handle.copy_from_cpu(output_state_h)
+        self.init_state_c_box_handle.reshape(output_state_c.shape)
+        self.init_state_c_box_handle.copy_from_cpu(output_state_c)
 
         # 运行predictor
         self.predictor.run()
@@ -176,27 +320,31 @@ class InferencePredictor:
         output_lens_handle = self.predictor.get_output_handle(self.output_names[1])
         output_lens = output_lens_handle.copy_to_cpu()
         output_state_h_handle = self.predictor.get_output_handle(self.output_names[2])
-        self.output_state_h = output_state_h_handle.copy_to_cpu()
         output_state_c_handle = self.predictor.get_output_handle(self.output_names[3])
-        self.output_state_c = output_state_c_handle.copy_to_cpu()
-        return output_chunk_probs, output_lens
+        new_state = StreamState(output_state_h=output_state_h_handle.copy_to_cpu(),
+                                output_state_c=output_state_c_handle.copy_to_cpu())
+        return output_chunk_probs, output_lens, new_state
 
     def predict_chunk_conformer(self, x_chunk, required_cache_size):
+        output_chunk_probs, self.stream_state = \
+            self.predict_chunk_conformer_state(x_chunk=x_chunk, required_cache_size=required_cache_size,
+                                               state=self.stream_state)
+        return output_chunk_probs
+
+    def predict_chunk_conformer_state(self, x_chunk, required_cache_size, state):
+        """使用指定的流式状态预测一个Conformer类模型的数据块
+
+        :param x_chunk: 数据块的特征
+        :param required_cache_size: 下一个数据块需要的缓存大小，小于0表示使用全部的历史缓存
+        :param state: 这个会话的流式状态StreamState
+        :return: 数据块的输出概率和更新后的流式状态
+        """
         if not ('former' in self.use_model and self.streaming):
             raise Exception(f'当前模型不支持该方法，当前模型为：{self.use_model}')
         # 设置输入
         self.speech_data_handle.reshape([x_chunk.shape[0], x_chunk.shape[1], x_chunk.shape[2]])
         self.speech_data_handle.copy_from_cpu(x_chunk.astype(np.float32))
-
-        self.offset_handle.reshape(self.offset.shape)
-        self.offset_handle.copy_from_cpu(self.offset)
-        required_cache_size = np.array([required_cache_size], dtype=np.int32)
-        self.required_cache_size_handle.reshape(required_cache_size.shape)
-        self.required_cache_size_handle.copy_from_cpu(required_cache_size)
-        self.cnn_cache_handle.reshape(self.cnn_cache.shape)
-        self.cnn_cache_handle.copy_from_cpu(self.cnn_cache)
-        self.att_cache_handle.reshape(self.att_cache.shape)
-        self.att_cache_handle.copy_from_cpu(self.att_cache)
+        self._set_conformer_state(state, required_cache_size=required_cache_size)
 
         # 运行predictor
         self.predictor.run()
@@ -205,16 +353,33 @@ class InferencePredictor:
         output_handle = self.predictor.get_output_handle(self.output_names[0])
         output_chunk_probs = output_handle.copy_to_cpu()
         att_cache_handle = self.predictor.get_output_handle(self.output_names[1])
-        self.att_cache = att_cache_handle.copy_to_cpu()
         cnn_cache_handle = self.predictor.get_output_handle(self.output_names[2])
-        self.cnn_cache = cnn_cache_handle.copy_to_cpu()
-        self.offset += output_chunk_probs.shape[1]
-        return output_chunk_probs
+        new_state = StreamState(offset=state.offset + output_chunk_probs.shape[1],
+                                att_cache=att_cache_handle.copy_to_cpu(),
+                                cnn_cache=cnn_cache_handle.copy_to_cpu())
+        return output_chunk_probs, new_state
+
+    # 设置Conformer类模型流式状态的输入
+    def _set_conformer_state(self, state, required_cache_size):
+        offset = np.array([state.offset], dtype=np.int32)
+        self.offset_handle.reshape(offset.shape)
+        self.offset_handle.copy_from_cpu(offset)
+        required_cache_size = np.array([required_cache_size], dtype=np.int32)
+        self.required_cache_size_handle.reshape(required_cache_size.shape)
+        self.required_cache_size_handle.copy_from_cpu(required_cache_size)
+        self.cnn_cache_handle.reshape(state.cnn_cache.shape)
+        self.cnn_cache_handle.copy_from_cpu(state.cnn_cache)
+        self.att_cache_handle.reshape(state.att_cache.shape)
+        self.att_cache_handle.copy_from_cpu(state.att_cache)
+
+    # 获取流式识别的状态，用于多个会话轮流使用同一个预测器
+    def get_stream_state(self):
+        return self.stream_state
+
+    # 恢复流式识别的状态
+    def set_stream_state(self, state):
+        self.stream_state = state
 
     # 重置流式识别，每次流式识别完成之后都要执行
     def reset_stream(self):
-        self.output_state_h = None
-        self.output_state_c = None
-        self.att_cache = np.zeros([0, 0, 0, 0], dtype=np.float32)
-        self.cnn_cache = np.zeros([0, 0, 0, 0], dtype=np.float32)
-        self.offset = np.array([0], dtype=np.int32)
+        self.stream_state = StreamState()
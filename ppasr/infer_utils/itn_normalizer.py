@@ -0,0 +1,114 @@
+import re
+import threading
+from collections import OrderedDict
+
+import cn2an
+
+from ppasr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+__all__ = ['InverseTextNormalizer', 'StreamITNState']
+
+# 按标点符号把文本切分成多个片段，数字、日期等不会跨过这些标点符号
+SPAN_PATTERN = re.compile('([，。！？、；：,!?;:\\s]+)')
+# 可能组成数字、日期、分数等的字，流式反标准化时不会在这些字附近切分
+NUMBER_CHARS = set('零〇一二三四五六七八九十百千万亿两幺点第负正分之')
+
+
+class StreamITNState(object):
+    """一个流式句子的反标准化状态"""
+
+    def __init__(self):
+        # 已经确定的原始文本和反标准化之后的文本，每个确定的片段的(原始长度, 反标准化之后的长度)
+        self.raw_text = ''
+        self.normalized_text = ''
+        self.segments = []
+
+
+class InverseTextNormalizer(object):
+    def __init__(self, cache_dir=None, cache_size=4096, use_cn2an=False):
+        """
+        文本反标准化工具，创建时就加载或者编译好FST，文本按标点符号切分成多个片段，每个片段的结果都会缓存，
+        流式识别时已经识别过的片段不需要重新反标准化，没有标点符号时使用normalize_stream()只处理新的文本
+
+        :param cache_dir: 保存编译好的FST的文件夹，多个进程和重启之后可以直接加载，为None时使用WeTextProcessing自带的FST
+        :param cache_size: 缓存最近反标准化的片段数量，为0时不使用缓存
+        :param use_cn2an: 是否使用cn2an代替WeTextProcessing，集束搜索解码器与WeTextProcessing有包冲突
+        """
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # FST不保证多个线程同时使用是安全的，复制的预测器共享同一个反标准化工具
+        self._normalize_lock = threading.Lock()
+        self.inv_normalizer = None
+        if not use_cn2an:
+            # 需要安装WeTextProcessing>=0.1.0
+            from itn.chinese.inverse_normalizer import InverseNormalizer
+            self.inv_normalizer = InverseNormalizer() if cache_dir is None else InverseNormalizer(cache_dir=cache_dir)
+        # 预热
+        self._normalize('近几年有一百二十三万人')
+        self._cache.clear()
+        logger.info('文本反标准化工具加载成功。')
+
+    def _normalize(self, text):
+        if self.inv_normalizer is None:
+            return cn2an.transform(text, "cn2an")
+        with self._normalize_lock:
+            return self.inv_normalizer.normalize(text)
+
+    def _normalize_span(self, span):
+        if self.cache_size <= 0:
+            return self._normalize(span)
+        with self._cache_lock:
+            if span in self._cache:
+                self._cache.move_to_end(span)
+                return self._cache[span]
+        result = self._normalize(span)
+        with self._cache_lock:
+            self._cache[span] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def __call__(self, text):
+        """对文本进行反标准化，只有没有缓存的片段才会执行反标准化"""
+        if len(text) == 0: return text
+        parts = SPAN_PATTERN.split(text)
+        # 奇数位置是分隔的标点符号，保持不变
+        return ''.join([part if i % 2 == 1 or len(part) == 0 else self._normalize_span(part)
+                        for i, part in enumerate(parts)])
+
+    @staticmethod
+    def _is_safe_cut(text, i, margin=2):
+        """判断在text[i]之前切分是否不会拆开数字、日期等，标点符号之后或者两边附近都没有数字相关的字才可以切分"""
+        if SPAN_PATTERN.match(text[i - 1]): return True
+        return not any(c in NUMBER_CHARS for c in text[max(i - margin, 0):i + margin])
+
+    def normalize_stream(self, state, text, stable_len=None, right_context=8):
+        """流式识别的增量反标准化，已经确定的前缀不会重新反标准化，只处理之后新的文本，计算量与句子的长度无关
+
+        :param state: StreamITNState，每个流式句子一个
+        :param text: 当前句子的识别结果
+        :param stable_len: text中不会再修改的前缀长度，为None时末尾right_context个字之外的部分都当作不会再修改
+        :param right_context: stable_len为None时，末尾可能还会被修改的字数
+        :return: 反标准化之后的文本
+        """
+        # 识别结果修改了已经确定的部分，去掉修改了的片段
+        while len(state.segments) > 0 and not text.startswith(state.raw_text):
+            raw_len, norm_len = state.segments.pop()
+            state.raw_text = state.raw_text[:len(state.raw_text) - raw_len]
+            state.normalized_text = state.normalized_text[:len(state.normalized_text) - norm_len]
+        start = len(state.raw_text)
+        if stable_len is None:
+            stable_len = len(text) - right_context
+        # 在稳定部分中找最后一个可以切分的位置，把之前的文本确定下来
+        for i in range(min(stable_len, len(text) - 1), start, -1):
+            if self._is_safe_cut(text, i):
+                raw_segment = text[start:i]
+                norm_segment = self(raw_segment)
+                state.raw_text += raw_segment
+                state.normalized_text += norm_segment
+                state.segments.append((len(raw_segment), len(norm_segment)))
+                break
+        return state.normalized_text + self(text[len(state.raw_text):])
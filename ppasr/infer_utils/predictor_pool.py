@@ -0,0 +1,79 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from ppasr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+__all__ = ['PoolBusyError', 'PredictorPool']
+
+
+class PoolBusyError(Exception):
+    """等待预测器的请求数量达到上限"""
+    pass
+
+
+class PredictorPool(object):
+    def __init__(self, predictors, max_waiting=32):
+        """
+        异步预测器池，在服务启动时创建并预热好全部预测器，每个预测器同时只执行一个请求，
+        预测在线程池中执行，不会阻塞事件循环
+
+        :param predictors: 已经预热的PPASRPredictor列表
+        :param max_waiting: 最多等待空闲预测器的请求数量，超过之后直接拒绝新的请求
+        """
+        assert len(predictors) >= 1, '至少需要一个预测器'
+        self.predictors = list(predictors)
+        self.max_waiting = max_waiting
+        self._num_waiting = 0
+        self._idle = None
+        self._executor = ThreadPoolExecutor(max_workers=len(self.predictors))
+
+    @property
+    def num_idle(self):
+        """空闲的预测器数量"""
+        return len(self.predictors) if self._idle is None else self._idle.qsize()
+
+    @property
+    def num_waiting(self):
+        """正在等待空闲预测器的请求数量"""
+        return self._num_waiting
+
+    def stats(self):
+        """预测器池的统计信息"""
+        return {'num_predictors': len(self.predictors),
+                'num_idle': self.num_idle,
+                'num_waiting': self.num_waiting,
+                'max_waiting': self.max_waiting}
+
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """在空闲的预测器上执行func(predictor, *args, **kwargs)
+
+        :param func: 执行的函数，第一个参数为预测器
+        :param timeout: 等待空闲预测器和执行预测的总超时时间，单位秒，为None时不限制
+        :return: func的返回值
+        """
+        loop = asyncio.get_running_loop()
+        # 队列需要在事件循环中创建
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for predictor in self.predictors:
+                self._idle.put_nowait(predictor)
+        deadline = None if timeout is None else loop.time() + timeout
+        # 有空闲的预测器时直接使用，只有需要等待的请求才计入等待数量
+        if not self._idle.empty():
+            predictor = self._idle.get_nowait()
+        else:
+            if self._num_waiting >= self.max_waiting:
+                raise PoolBusyError(f'等待的请求数量已达到上限：{self.max_waiting}')
+            self._num_waiting += 1
+            try:
+                predictor = await asyncio.wait_for(self._idle.get(), timeout)
+            finally:
+                self._num_waiting -= 1
+        future = loop.run_in_executor(self._executor, functools.partial(func, predictor, *args, **kwargs))
+        # 超时之后预测仍然在执行，执行完成之后才能把预测器放回队列
+        future.add_done_callback(lambda _: self._idle.put_nowait(predictor))
+        remaining = None if deadline is None else max(0.0, deadline - loop.time())
+        return await asyncio.wait_for(asyncio.shield(future), remaining)
@@ -1,6 +1,9 @@
+import copy
 import json
 import os
 import re
+import threading
+from collections import OrderedDict
 
 import numpy as np
 import paddle.inference as paddle_infer
@@ -13,7 +16,21 @@ __all__ = ['PunctuationPredictor']
 
 
 class PunctuationPredictor:
-    def __init__(self, model_dir, use_gpu=True, gpu_mem=500, num_threads=4):
+    def __init__(self, model_dir, use_gpu=True, gpu_mem=500, num_threads=4, max_seq_len=256, window_overlap=32,
+                 batch_size=64, cache_size=1024):
+        """
+        标点符号预测器，长文本会切分成有重叠的窗口，多个窗口组成批量一起推理
+
+        :param model_dir: 标点符号模型文件夹路径
+        :param use_gpu: 是否使用GPU预测
+        :param gpu_mem: 预先分配的GPU显存大小，单位MB
+        :param num_threads: 使用CPU预测时的线程数量
+        :param max_seq_len: 每个窗口的最大长度，包括开始和结束两个特殊符号
+        :param window_overlap: 相邻两个窗口重叠的字数，重叠部分的标点使用离窗口边缘更远的结果
+        :param batch_size: 每次推理的最大窗口数量
+        :param cache_size: 缓存最近加标点符号的文本数量，为0时不使用缓存
+        """
+        assert max_seq_len - 2 > window_overlap >= 0, 'window_overlap需要大于等于0并且小于max_seq_len - 2'
         # 创建 config
         model_path = os.path.join(model_dir, 'model.pdmodel')
         params_path = os.path.join(model_dir, 'model.pdiparams')
@@ -38,13 +55,7 @@ class PunctuationPredictor:
 
         # 根据 config 创建 predictor
         self.predictor = paddle_infer.create_predictor(self.config)
-
-        # 获取输入层
-        self.input_ids_handle = self.predictor.get_input_handle('input_ids')
-        self.token_type_ids_handle = self.predictor.get_input_handle('token_type_ids')
-
-        # 获取输出的名称
-        self.output_names = self.predictor.get_output_names()
+        self._init_handles()
 
         self._punc_list = []
         if not os.path.join(model_dir, 'vocab.txt'):
@@ -54,33 +65,78 @@ class PunctuationPredictor:
                 self._punc_list.append(line.strip())
 
         self.tokenizer = ErnieTokenizer.from_pretrained(pretrained_token)
+        self.window_size = max_seq_len - 2
+        self.window_overlap = window_overlap
+        self.batch_size = batch_size
+        # 缓存加标点符号的结果，key为清理之后的文本，复制的预测器共享同一个缓存
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
 
         # 预热
         self('近几年不但我用书给女儿儿压岁也劝说亲朋不要给女儿压岁钱而改送压岁书')
+        self._cache.clear()
         logger.info('标点符号模型加载成功。')
 
+    # 获取输入层和输出的名称
+    def _init_handles(self):
+        self.input_ids_handle = self.predictor.get_input_handle('input_ids')
+        self.token_type_ids_handle = self.predictor.get_input_handle('token_type_ids')
+        self.output_names = self.predictor.get_output_names()
+
+    def clone(self):
+        """复制一个标点符号预测器，与当前预测器共享模型权重、分词器和缓存，可以在另一个线程中使用"""
+        predictor = copy.copy(self)
+        predictor.predictor = self.predictor.clone()
+        predictor._init_handles()
+        return predictor
+
     def _clean_text(self, text):
         text = text.lower()
         text = re.sub('[^A-Za-z0-9\u4e00-\u9fa5]', '', text)
         text = re.sub(f'[{"".join([p for p in self._punc_list][1:])}]', '', text)
         return text
 
+    def _get_cache(self, key):
+        with self._cache_lock:
+            if key not in self._cache: return None
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+    def _put_cache(self, key, value):
+        if self.cache_size <= 0: return
+        with self._cache_lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
     # 预处理文本
-    def preprocess(self, text: str):
-        clean_text = self._clean_text(text)
-        if len(clean_text) == 0: return None
-        tokenized_input = self.tokenizer(list(clean_text), return_length=True, is_split_into_words=True)
-        input_ids = tokenized_input['input_ids']
-        seg_ids = tokenized_input['token_type_ids']
-        seq_len = tokenized_input['seq_len']
-        return input_ids, seg_ids, seq_len
-
-    def infer(self, input_ids: list, seg_ids: list):
+    def preprocess(self, clean_text: str):
+        """把清理之后的文本转换为token，不包括开始和结束的特殊符号"""
+        tokenized_input = self.tokenizer(list(clean_text), is_split_into_words=True)
+        return tokenized_input['input_ids'][1:-1]
+
+    def _split_windows(self, token_ids):
+        """把token切分成有重叠的窗口，返回每个窗口的开始位置"""
+        stride = self.window_size - self.window_overlap
+        starts = [0]
+        while starts[-1] + self.window_size < len(token_ids):
+            starts.append(starts[-1] + stride)
+        return starts
+
+    def infer(self, input_ids: np.ndarray, seg_ids: np.ndarray):
+        """一个批量的窗口推理
+
+        :param input_ids: 大小为(batch, seq_len)的token，不足的部分使用pad_token_id填充
+        :param seg_ids: 大小为(batch, seq_len)的token_type_ids
+        :return: 大小为(batch, seq_len)的标点符号标签
+        """
         # 设置输入
-        self.input_ids_handle.reshape([1, len(input_ids)])
-        self.token_type_ids_handle.reshape([1, len(seg_ids)])
-        self.input_ids_handle.copy_from_cpu(np.array([input_ids]).astype('int64'))
-        self.token_type_ids_handle.copy_from_cpu(np.array([seg_ids]).astype('int64'))
+        self.input_ids_handle.reshape(list(input_ids.shape))
+        self.token_type_ids_handle.reshape(list(seg_ids.shape))
+        self.input_ids_handle.copy_from_cpu(input_ids.astype('int64'))
+        self.token_type_ids_handle.copy_from_cpu(seg_ids.astype('int64'))
 
         # 运行predictor
         self.predictor.run()
@@ -88,29 +144,90 @@ class PunctuationPredictor:
         # 获取输出
         output_handle = self.predictor.get_output_handle(self.output_names[0])
         output_data = output_handle.copy_to_cpu()
-        return output_data
+        return output_data.reshape(input_ids.shape)
+
+    def _infer_windows(self, windows):
+        """按长度排序之后批量推理全部窗口，返回与输入顺序一致的每个窗口的标签"""
+        cls_id, sep_id = self.tokenizer.cls_token_id, self.tokenizer.sep_token_id
+        pad_id = self.tokenizer.pad_token_id
+        sorted_indexes = sorted(range(len(windows)), key=lambda i: len(windows[i]))
+        results = [None] * len(windows)
+        for i in range(0, len(sorted_indexes), self.batch_size):
+            batch_indexes = sorted_indexes[i:i + self.batch_size]
+            max_len = max(len(windows[idx]) for idx in batch_indexes) + 2
+            input_ids = np.full((len(batch_indexes), max_len), pad_id, dtype=np.int64)
+            for j, idx in enumerate(batch_indexes):
+                input_ids[j, :len(windows[idx]) + 2] = [cls_id] + windows[idx] + [sep_id]
+            seg_ids = np.zeros_like(input_ids)
+            preds = self.infer(input_ids=input_ids, seg_ids=seg_ids)
+            for j, idx in enumerate(batch_indexes):
+                results[idx] = preds[j, 1:len(windows[idx]) + 1]
+        return results
+
+    def punctuate_token(self, token, label):
+        """在token之后加上标签对应的标点符号"""
+        return token + self._punc_list[label] if label != 0 else token
 
     # 后处理识别结果
-    def postprocess(self, input_ids, seq_len, preds):
-        tokens = self.tokenizer.convert_ids_to_tokens(input_ids[1:seq_len - 1])
-        labels = preds[1:seq_len - 1].tolist()
+    def postprocess(self, tokens, labels):
         assert len(tokens) == len(labels)
-
-        text = ''
-        for t, l in zip(tokens, labels):
-            text += t
-            if l != 0:
-                text += self._punc_list[l]
-        return text
+        return ''.join([self.punctuate_token(t, l) for t, l in zip(tokens, labels)])
+
+    def predict_labels(self, clean_texts):
+        """批量预测清理之后的文本的标点符号标签，长文本切分成有重叠的窗口之后合并结果
+
+        :param clean_texts: 使用_clean_text清理之后的文本列表
+        :return: 与输入顺序一致的列表，每个元素为(每个字的token, 每个字之后的标点符号标签)
+        """
+        token_ids_list, starts_list, windows = [], [], []
+        for clean_text in clean_texts:
+            token_ids = self.preprocess(clean_text)
+            starts = self._split_windows(token_ids)
+            token_ids_list.append(token_ids)
+            starts_list.append(starts)
+            windows.extend([token_ids[s:s + self.window_size] for s in starts])
+        # 全部文本的窗口一起组成批量推理
+        window_preds = self._infer_windows(windows) if len(windows) > 0 else []
+        # 合并每个文本的窗口，重叠部分从中间分开，前一半使用前一个窗口的结果，后一半使用后一个窗口的结果
+        results, k = [], 0
+        for token_ids, starts in zip(token_ids_list, starts_list):
+            labels = np.zeros((len(token_ids),), dtype=np.int64)
+            for j, start in enumerate(starts):
+                preds = window_preds[k + j]
+                begin = start if j == 0 else (start + starts[j - 1] + self.window_size) // 2
+                labels[begin:start + len(preds)] = preds[begin - start:]
+            k += len(starts)
+            results.append((self.tokenizer.convert_ids_to_tokens(token_ids), labels.tolist()))
+        return results
+
+    def predict_batch(self, texts):
+        """批量加标点符号，每条文本单独加标点符号，长文本切分成有重叠的窗口之后合并结果
+
+        :param texts: 文本列表
+        :return: 与输入顺序一致的加标点符号之后的文本列表
+        """
+        results = list(texts)
+        # 需要推理的文本，相同的文本只推理一次
+        pending = {}
+        for i, text in enumerate(texts):
+            clean_text = self._clean_text(text)
+            if len(clean_text) == 0: continue
+            cached = self._get_cache(clean_text)
+            if cached is not None:
+                results[i] = cached
+                continue
+            pending.setdefault(clean_text, []).append(i)
+        if len(pending) == 0: return results
+        for clean_text, (tokens, labels) in zip(pending.keys(), self.predict_labels(list(pending.keys()))):
+            text = self.postprocess(tokens, labels)
+            self._put_cache(clean_text, text)
+            for i in pending[clean_text]:
+                results[i] = text
+        return results
 
     def __call__(self, text: str) -> str:
-        # 数据batch处理
         try:
-            input_ids, seg_ids, seq_len = self.preprocess(text)
-            preds = self.infer(input_ids=input_ids, seg_ids=seg_ids)
-            if len(preds.shape) == 2:
-                preds = preds[0]
-            text = self.postprocess(input_ids, seq_len, preds)
+            text = self.predict_batch([text])[0]
         except Exception as e:
             logger.error(e)
         return text
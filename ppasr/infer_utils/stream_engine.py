@@ -0,0 +1,183 @@
+import itertools
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+
+from ppasr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+__all__ = ['StreamSession', 'StreamingEngine']
+
+
+class StreamSession(object):
+    """一个流式识别会话，会话的识别状态保存在这里，而不是保存在预测器中
+
+    :param session_id: 会话ID
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        # 预测器的流式识别状态，为None时表示还没有开始识别
+        self.state = None
+        # 等待识别的音频数据
+        self.pending = deque()
+        # 是否已经在等待队列中或者正在识别
+        self.scheduled = False
+        self.closed = False
+        # 增量标点符号和增量反标准化的状态
+        self.pun_state = None
+        self.itn_state = None
+
+
+class StreamingEngine(object):
+    def __init__(self, predictors, max_sessions=100, use_pun=False, is_itn=False, punctuator=None):
+        """
+        多会话流式识别引擎，多个会话共享少量的预测器，每个预测器由一个工作线程负责，
+        哪个会话有新的音频数据就把会话的状态加载到空闲的预测器中识别，识别完成再把状态保存回会话
+
+        :param predictors: PPASRPredictor列表，每个预测器对应一个工作线程
+        :param max_sessions: 最多同时存在的会话数量
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        :param punctuator: StreamPunctuator，不为None时使用增量标点符号，识别过程中的结果也有标点符号，
+                           否则只在一句话结束时加标点符号
+        """
+        assert len(predictors) >= 1, '至少需要一个预测器'
+        self.max_sessions = max_sessions
+        self.use_pun = use_pun
+        self.is_itn = is_itn
+        self.punctuator = punctuator if use_pun else None
+        self._sessions = {}
+        self._session_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready_queue = queue.Queue()
+        self._workers = []
+        for predictor in predictors:
+            worker = threading.Thread(target=self._run, args=(predictor,), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def num_sessions(self):
+        """当前的会话数量"""
+        return len(self._sessions)
+
+    def create_session(self):
+        """创建一个新的会话，会话数量达到上限时返回None"""
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                return None
+            session = StreamSession(next(self._session_ids))
+            self._sessions[session.session_id] = session
+        return session
+
+    def close_session(self, session):
+        """关闭会话，释放会话的识别状态"""
+        with self._lock:
+            session.closed = True
+            self._sessions.pop(session.session_id, None)
+            if not session.scheduled:
+                session.state = None
+
+    def push(self, session, audio_data, is_end=False):
+        """向会话输入音频数据
+
+        :param session: 会话
+        :param audio_data: 音频的PCM字节流或者numpy数据
+        :param is_end: 是否结束当前这句话，结束之后会重置识别状态
+        :return: 识别结果的Future，结果与PPASRPredictor.predict_stream()一致
+        """
+        future = Future()
+        with self._lock:
+            if session.closed:
+                raise Exception(f'会话已关闭：{session.session_id}')
+            session.pending.append((audio_data, is_end, future))
+            # 同一个会话同时只能在一个预测器中识别，保证音频数据的顺序
+            if not session.scheduled:
+                session.scheduled = True
+                self._ready_queue.put(session)
+        return future
+
+    def _run(self, predictor):
+        while True:
+            session = self._ready_queue.get()
+            # 任何错误都不能让工作线程退出，否则这个预测器之后再也不会被使用
+            try:
+                self._run_session(predictor, session)
+            except Exception as e:
+                logger.error(f'会话{session.session_id}识别失败，错误信息：{e}')
+                with self._lock:
+                    pending = list(session.pending)
+                    session.pending.clear()
+                    session.scheduled = False
+                    session.state = None
+                for _, _, future in pending:
+                    self._set_future(future, exception=e)
+
+    def _run_session(self, predictor, session):
+        """在预测器中识别一个会话全部等待识别的音频数据，识别完成之后把状态保存回会话"""
+        predictor.set_stream_state(session.state)
+        while True:
+            with self._lock:
+                if len(session.pending) == 0:
+                    session.scheduled = False
+                    session.state = None if session.closed else predictor.get_stream_state()
+                    return
+                audio_data, is_end, future = session.pending.popleft()
+            # 已经被取消的请求（例如请求超时）不需要再识别，一句话结束的请求仍然要重置识别状态
+            if not future.set_running_or_notify_cancel():
+                if is_end:
+                    self._reset_sentence(predictor, session)
+                continue
+            try:
+                if self.punctuator is None:
+                    result = predictor.predict_stream(audio_data=audio_data, is_end=is_end,
+                                                      use_pun=self.use_pun, is_itn=self.is_itn)
+                else:
+                    result = predictor.predict_stream(audio_data=audio_data, is_end=is_end,
+                                                      use_pun=False, is_itn=False)
+                    result = self._punctuate(predictor, session, result, is_end)
+                if is_end:
+                    self._reset_sentence(predictor, session)
+                self._set_future(future, result=result)
+            except Exception as e:
+                logger.error(f'会话{session.session_id}识别失败，错误信息：{e}')
+                self._set_future(future, exception=e)
+
+    @staticmethod
+    def _reset_sentence(predictor, session):
+        """一句话结束之后重置编码器的缓存和解码状态，会话可以继续识别下一句话"""
+        predictor.set_stream_state(None)
+        session.pun_state, session.itn_state = None, None
+
+    @staticmethod
+    def _set_future(future, result=None, exception=None):
+        """设置识别结果，Future已经被取消（例如连接断开或者服务关闭）时直接丢弃结果"""
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def _punctuate(self, predictor, session, result, is_end):
+        """使用增量标点符号处理识别结果，识别过程中只使用已经确定的标点符号，不等待加标点符号完成"""
+        if result is None: return None
+        if session.pun_state is None:
+            session.pun_state = self.punctuator.create_state()
+        pun_future = self.punctuator.submit(session.pun_state, result['text'], is_end=is_end)
+        if is_end:
+            # 一句话结束时需要完整的标点符号，只等待这一次
+            text, fixed_len = pun_future.result()
+        else:
+            text, fixed_len = self.punctuator.render(session.pun_state, result['text'])
+        if self.is_itn:
+            # 只对已经确定标点符号之后的新文本进行反标准化
+            if session.itn_state is None:
+                session.itn_state = predictor.create_itn_stream_state()
+            text = predictor.inverse_text_normalization_stream(
+                session.itn_state, text, stable_len=len(text) if is_end else fixed_len)
+        return {'text': text, 'score': result['score']}
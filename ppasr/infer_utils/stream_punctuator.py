@@ -0,0 +1,120 @@
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ppasr.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+__all__ = ['StreamPunctuationState', 'StreamPunctuator']
+
+
+class StreamPunctuationState(object):
+    """一个流式会话当前句子的标点符号状态"""
+
+    def __init__(self):
+        # 已经确定标点符号的原始文本、每个原始字符加上标点符号之后的结果（被清理掉的字符为空字符串）和拼接好的结果，
+        # 三个一起替换，其他线程读取时不需要加锁
+        self.committed = ('', [], '')
+        # 最新一次提交的编号，工作线程只处理最新的结果
+        self.version = 0
+
+
+class StreamPunctuator(object):
+    def __init__(self, pun_predictor, left_context=30, right_context=5, min_new_chars=4):
+        """
+        流式识别的增量标点符号，只给识别结果中已经稳定的前缀加标点符号，已经加好标点符号的部分不会再重新处理，
+        每次只处理上一次之后新的文本，计算量与句子的长度无关，加标点符号在单独的工作线程中执行，不会阻塞识别
+
+        :param pun_predictor: PunctuationPredictor，只在工作线程中使用
+        :param left_context: 作为上下文输入到模型的已经确定标点符号的字数
+        :param right_context: 末尾这些字可能还会被解码器修改，只作为上下文，不确定它们的标点符号
+        :param min_new_chars: 稳定的新字数达到这个数量才加标点符号，句子结束时全部加上标点符号
+        """
+        self.pun_predictor = pun_predictor
+        self.left_context = left_context
+        self.right_context = right_context
+        self.min_new_chars = min_new_chars
+        self._versions = itertools.count(1)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @staticmethod
+    def create_state():
+        return StreamPunctuationState()
+
+    def clean_text(self, text):
+        return self.pun_predictor._clean_text(text)
+
+    @staticmethod
+    def _valid_committed(state, text):
+        """获取与当前识别结果一致的已经确定标点符号的部分，解码器修改了这部分时截断"""
+        raw_text, pieces, joined = state.committed
+        if text.startswith(raw_text):
+            return raw_text, pieces, joined
+        k = len(os.path.commonprefix([raw_text, text]))
+        pieces = pieces[:k]
+        return text[:k], pieces, ''.join(pieces)
+
+    def render(self, state, text):
+        """使用已经确定的标点符号组成当前的文本，还没有确定标点符号的部分只做清理
+
+        :param state: StreamPunctuationState
+        :param text: 当前句子的识别结果
+        :return: (加上已经确定的标点符号之后的文本, 已经确定标点符号的部分的长度)
+        """
+        raw_text, _, joined = self._valid_committed(state, text)
+        return joined + self.clean_text(text[len(raw_text):]), len(joined)
+
+    def submit(self, state, text, is_end=False):
+        """提交当前句子最新的识别结果，在工作线程中给新的稳定部分加标点符号
+
+        :param state: StreamPunctuationState
+        :param text: 当前句子的识别结果
+        :param is_end: 是否是这句话最后的识别结果，为True时全部文本都会加上标点符号
+        :return: Future，结果与render()一致
+        """
+        state.version = next(self._versions)
+        return self._executor.submit(self._update, state, state.version, text, is_end)
+
+    def _update(self, state, version, text, is_end):
+        # 已经有更新的识别结果，跳过这一次，工作线程落后时每个会话只处理最新的结果
+        if not is_end and version != state.version:
+            return self.render(state, text)
+        raw_text, pieces, joined = self._valid_committed(state, text)
+        k = len(raw_text)
+        # 只处理还没有确定标点符号的部分
+        tail = text[k:]
+        tail_chars = [self.clean_text(c) for c in tail]
+        clean_indexes = [i for i, c in enumerate(tail_chars) if c != '']
+        num_stable = len(clean_indexes) if is_end else len(clean_indexes) - self.right_context
+        if num_stable < (1 if is_end else self.min_new_chars):
+            state.committed = (raw_text, pieces, joined)
+            return joined + ''.join(tail_chars), len(joined)
+        # 左边的上下文为已经确定标点符号的最后几个字
+        left_chars, j = [], k - 1
+        while j >= 0 and len(left_chars) < self.left_context:
+            c = self.clean_text(text[j])
+            if c != '': left_chars.append(c)
+            j -= 1
+        left_text = ''.join(reversed(left_chars))
+        # 输入模型的文本为左边的上下文、新的稳定部分和右边的上下文
+        window = left_text + ''.join(tail_chars)
+        try:
+            tokens, labels = self.pun_predictor.predict_labels([window])[0]
+        except Exception as e:
+            logger.error(f'流式加标点符号失败，错误信息：{e}')
+            return joined + ''.join(tail_chars), len(joined)
+        if len(tokens) != len(window):
+            logger.warning(f'标点符号模型的token与文字没有一一对应，跳过：{window}')
+            return joined + ''.join(tail_chars), len(joined)
+        raw_end = len(tail) if is_end else clean_indexes[num_stable - 1] + 1
+        new_pieces, pos = [], len(left_text)
+        for c in tail_chars[:raw_end]:
+            if c == '':
+                new_pieces.append('')
+                continue
+            new_pieces.append(self.pun_predictor.punctuate_token(tokens[pos], labels[pos]))
+            pos += 1
+        joined = joined + ''.join(new_pieces)
+        state.committed = (text[:k + raw_end], pieces + new_pieces, joined)
+        return joined + ''.join(tail_chars[raw_end:]), len(joined)
@@ -0,0 +1,87 @@
+import math
+from collections import deque
+
+import numpy as np
+
+__all__ = ['VADEndpointer']
+
+
+class VADEndpointer(object):
+    def __init__(self, vad_predictor, sample_rate=16000, endpoint_silence_ms=800, speech_pad_ms=None):
+        """
+        流式语音端点检测，丢弃语音前后的静音，只把语音部分输入到模型，语音之后的静音超过endpoint_silence_ms时自动结束当前的句子
+
+        :param vad_predictor: VADPredictor，每个流式会话需要使用单独的VADPredictor保存模型状态
+        :param sample_rate: 音频采样率，只支持8K或者16K
+        :param endpoint_silence_ms: 语音之后的静音超过这个长度就结束当前的句子，单位毫秒
+        :param speech_pad_ms: 语音前后保留的静音长度，为None时使用VADPredictor的speech_pad_ms
+        """
+        self.vad_predictor = vad_predictor
+        self.sample_rate = sample_rate
+        self.window_size_samples = vad_predictor.window_size_samples
+        if speech_pad_ms is None:
+            speech_pad_ms = vad_predictor.speech_pad_ms
+        window_ms = self.window_size_samples * 1000 / sample_rate
+        self.pad_windows = max(1, int(math.ceil(speech_pad_ms / window_ms)))
+        self.endpoint_windows = max(1, int(math.ceil(endpoint_silence_ms / window_ms)))
+        self.threshold = vad_predictor.threshold
+        self.neg_threshold = vad_predictor.threshold - 0.15
+        self.reset()
+
+    def reset(self):
+        """重置端点检测的状态"""
+        self.vad_predictor.reset_states()
+        self.triggered = False
+        # 不足一个窗口的音频
+        self._remained_samples = np.zeros((0,), dtype=np.float32)
+        # 语音开始之前的静音，语音开始时一起输出
+        self._pre_roll = deque(maxlen=self.pad_windows)
+        # 语音之后的静音，语音恢复时才输出，结束句子时只输出开始的一部分
+        self._silence = []
+
+    def process(self, samples, is_end=False):
+        """输入新的音频，返回需要输入到模型的语音片段
+
+        :param samples: 一维的音频数据，数据类型为：np.float32
+        :param is_end: 是否是最后一段音频
+        :return: 语音片段的列表，每个元素为(音频数据, 是否结束句子)
+        """
+        samples = np.concatenate([self._remained_samples, samples.astype(np.float32)])
+        num_windows = len(samples) // self.window_size_samples
+        self._remained_samples = samples[num_windows * self.window_size_samples:]
+        outputs, current = [], []
+        for i in range(num_windows):
+            window = samples[i * self.window_size_samples:(i + 1) * self.window_size_samples]
+            speech_prob = self.vad_predictor(window, self.sample_rate).item()
+            if not self.triggered:
+                if speech_prob >= self.threshold:
+                    self.triggered = True
+                    current.extend(self._pre_roll)
+                    current.append(window)
+                    self._pre_roll.clear()
+                else:
+                    self._pre_roll.append(window)
+                continue
+            if speech_prob < self.neg_threshold or (self._silence and speech_prob < self.threshold):
+                self._silence.append(window)
+                # 静音时间足够长，结束当前的句子，丢弃多余的静音
+                if len(self._silence) >= self.endpoint_windows:
+                    current.extend(self._silence[:self.pad_windows])
+                    outputs.append((np.concatenate(current), True))
+                    current = []
+                    self._pre_roll.extend(self._silence[-self.pad_windows:])
+                    self._silence = []
+                    self.triggered = False
+            else:
+                current.extend(self._silence)
+                current.append(window)
+                self._silence = []
+        if is_end:
+            if self.triggered:
+                current.extend(self._silence[:self.pad_windows])
+                current.append(self._remained_samples)
+                outputs.append((np.concatenate(current), True))
+            self.reset()
+        elif len(current) > 0:
+            outputs.append((np.concatenate(current), False))
+        return outputs
@@ -1,4 +1,6 @@
+import itertools
 import os
+import threading
 from typing import List
 
 import numpy as np
@@ -7,6 +9,57 @@ from ppasr.utils.logger import setup_logger
 
 logger = setup_logger(__name__)
 
+GRAPH_OPTIMIZATION_LEVELS = {'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+                             'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                             'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+                             'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL}
+
+# 相同配置的VAD共享同一个推理会话，会话可以被多个线程同时调用，模型状态保存在每个VADPredictor中
+_session_cache = {}
+_session_lock = threading.Lock()
+
+
+def create_session(path, intra_op_num_threads=1, inter_op_num_threads=1, graph_optimization_level='all',
+                   optimized_model_path=None, share_session=True):
+    """创建ONNX Runtime推理会话
+
+    :param path: 模型文件路径
+    :param intra_op_num_threads: 算子内部并行的线程数量
+    :param inter_op_num_threads: 算子之间并行的线程数量
+    :param graph_optimization_level: 图优化级别，支持：disable、basic、extended、all
+    :param optimized_model_path: 优化后模型的保存路径，文件已经存在时直接加载，跳过图优化
+    :param share_session: 是否与相同配置的VAD共享推理会话
+    :return: 推理会话
+    """
+    if graph_optimization_level not in GRAPH_OPTIMIZATION_LEVELS:
+        raise Exception(f'不支持该图优化级别：{graph_optimization_level}，'
+                        f'支持的级别有：{list(GRAPH_OPTIMIZATION_LEVELS.keys())}')
+    key = (os.path.realpath(path), intra_op_num_threads, inter_op_num_threads, graph_optimization_level,
+           optimized_model_path)
+    with _session_lock:
+        if share_session and key in _session_cache:
+            return _session_cache[key]
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads
+        options.inter_op_num_threads = inter_op_num_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        model_path = path
+        if optimized_model_path is not None and os.path.exists(optimized_model_path) \
+                and os.path.getmtime(optimized_model_path) >= os.path.getmtime(path):
+            # 已经优化过的模型不需要再次优化
+            model_path = optimized_model_path
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+        else:
+            options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization_level]
+            if optimized_model_path is not None:
+                os.makedirs(os.path.dirname(os.path.abspath(optimized_model_path)), exist_ok=True)
+                options.optimized_model_filepath = optimized_model_path
+        session = onnxruntime.InferenceSession(model_path, sess_options=options,
+                                               providers=['CPUExecutionProvider'])
+        if share_session:
+            _session_cache[key] = session
+    return session
+
 
 class VADPredictor(object):
     """
@@ -21,7 +74,14 @@ class VADPredictor(object):
                  min_speech_duration_ms: int = 250,
                  min_silence_duration_ms: int = 100,
                  window_size_samples: int = 512,
-                 speech_pad_ms: int = 30):
+                 speech_pad_ms: int = 30,
+                 num_lanes: int = 1,
+                 lane_overlap_ms: int = 1000,
+                 intra_op_num_threads: int = 1,
+                 inter_op_num_threads: int = 1,
+                 graph_optimization_level: str = 'all',
+                 optimized_model_path: str = None,
+                 share_session: bool = True):
         """
 
         :param path: 模型文件路径
@@ -30,18 +90,30 @@ class VADPredictor(object):
         :param min_silence_duration_ms: 最小检测音频静音的长度
         :param window_size_samples: VAD模型训练使用采样率是16000，该参数是512、1024、1536，采样率是8000，该参数是256,512、768
         :param speech_pad_ms: 语音填充的长度
+        :param num_lanes: 检测整段音频时把音频切分成多少段并行推理，为1时逐个窗口推理
+        :param lane_overlap_ms: 每一段音频提前开始推理的长度，用于预热模型状态，这部分的结果会被丢弃
+        :param intra_op_num_threads: 算子内部并行的线程数量
+        :param inter_op_num_threads: 算子之间并行的线程数量
+        :param graph_optimization_level: 图优化级别，支持：disable、basic、extended、all
+        :param optimized_model_path: 优化后模型的保存路径，第一次启动时保存，之后直接加载优化后的模型
+        :param share_session: 是否与相同配置的VAD共享推理会话，多个VAD不会各自创建线程池
         """
         if path is None:
             path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'silero_vad.onnx')
-        self.session = onnxruntime.InferenceSession(path)
-        self.session.intra_op_num_threads = 1
-        self.session.inter_op_num_threads = 1
+        self.session = create_session(path,
+                                      intra_op_num_threads=intra_op_num_threads,
+                                      inter_op_num_threads=inter_op_num_threads,
+                                      graph_optimization_level=graph_optimization_level,
+                                      optimized_model_path=optimized_model_path,
+                                      share_session=share_session)
 
         self.threshold = threshold
         self.min_speech_duration_ms = min_speech_duration_ms
         self.min_silence_duration_ms = min_silence_duration_ms
         self.window_size_samples = window_size_samples
         self.speech_pad_ms = speech_pad_ms
+        self.num_lanes = num_lanes
+        self.lane_overlap_ms = lane_overlap_ms
 
         self.triggered = False
         self.temp_end = 0
@@ -117,13 +189,16 @@ class VADPredictor(object):
 
         audio_length_samples = len(audio)
 
-        speech_probs = []
-        for current_start_sample in range(0, audio_length_samples, self.window_size_samples):
-            chunk = audio[current_start_sample: current_start_sample + self.window_size_samples]
-            if len(chunk) < self.window_size_samples:
-                chunk = np.pad(chunk, (0, int(self.window_size_samples - len(chunk))))
-            speech_prob = self(chunk, sampling_rate).item()
-            speech_probs.append(speech_prob)
+        if self.num_lanes > 1:
+            speech_probs = self._get_speech_probs_batch(audio, sampling_rate)
+        else:
+            speech_probs = []
+            for current_start_sample in range(0, audio_length_samples, self.window_size_samples):
+                chunk = audio[current_start_sample: current_start_sample + self.window_size_samples]
+                if len(chunk) < self.window_size_samples:
+                    chunk = np.pad(chunk, (0, int(self.window_size_samples - len(chunk))))
+                speech_prob = self(chunk, sampling_rate).item()
+                speech_probs.append(speech_prob)
 
         triggered = False
         speeches: List[dict] = []
@@ -174,6 +249,143 @@ class VADPredictor(object):
 
         return speeches
 
+    def _get_speech_probs_batch(self, audio, sampling_rate):
+        """把音频切分成num_lanes段，每一段使用独立的模型状态，每一步把所有段的一个窗口组成一个批量推理，最后按顺序拼接每个窗口的语音概率
+
+        :param audio: 一维的音频数据，数据类型为：np.float32
+        :param sampling_rate: 音频采样率，只支持8K或者16K
+        :return: 每个窗口的语音概率
+        """
+        window_size_samples = self.window_size_samples
+        num_windows = (len(audio) + window_size_samples - 1) // window_size_samples
+        if num_windows == 0:
+            return np.zeros((0,), dtype=np.float32)
+        # 最后多加一个全零的窗口，已经结束的段使用这个窗口推理
+        windows = np.zeros(((num_windows + 1) * window_size_samples,), dtype=np.float32)
+        windows[:len(audio)] = audio
+        windows = windows.reshape((num_windows + 1, window_size_samples))
+
+        num_lanes = min(self.num_lanes, num_windows)
+        lane_size = (num_windows + num_lanes - 1) // num_lanes
+        overlap_windows = int(sampling_rate * self.lane_overlap_ms / 1000) // window_size_samples
+        # 每一段需要输出结果的窗口范围，以及提前预热开始的窗口
+        lane_starts = np.arange(num_lanes) * lane_size
+        lane_ends = np.minimum(lane_starts + lane_size, num_windows)
+        warmup_starts = np.maximum(0, lane_starts - overlap_windows)
+        num_steps = int((lane_ends - warmup_starts).max())
+
+        speech_probs = np.zeros((num_windows,), dtype=np.float32)
+        self.reset_states(num_lanes)
+        for step in range(num_steps):
+            indexes = warmup_starts + step
+            valid = indexes < lane_ends
+            x = windows[np.where(valid, indexes, num_windows)]
+            out = self(x, sampling_rate).reshape(-1)
+            mask = valid & (indexes >= lane_starts)
+            speech_probs[indexes[mask]] = out[mask]
+        return speech_probs.tolist()
+
+    def speech_segments(self, audio_blocks, sampling_rate):
+        """增量的语音活动检测，逐块输入音频，每检测到一个完整的语音片段就马上返回，切分结果与get_speech_timestamps()一致。
+        只保留还没有结束的语音片段的音频，内存占用不会随着音频变长而增加
+
+        :param audio_blocks: 一维音频数据块的迭代器，数据类型为：np.float32
+        :param sampling_rate: 音频采样率，只支持8K或者16K
+        :return: 语音片段的生成器，每个元素包含开始位置start、结束位置end（单位为采样点）和片段的音频数据samples
+        """
+        self.reset_states()
+        window_size_samples = self.window_size_samples
+        min_speech_samples = sampling_rate * self.min_speech_duration_ms / 1000
+        min_silence_samples = sampling_rate * self.min_silence_duration_ms / 1000
+        speech_pad_samples = sampling_rate * self.speech_pad_ms / 1000
+        neg_threshold = self.threshold - 0.15
+
+        # 缓存的音频和缓存开始的位置
+        buffer, buffer_start = np.zeros((0,), dtype=np.float32), 0
+        # 下一个窗口开始的位置
+        current_start_sample = 0
+        triggered, temp_end, speech_start = False, 0, 0
+        # 已经结束的语音片段，需要知道下一个语音片段的开始位置才能确定结束位置的填充
+        pending = None
+
+        def _join(speech):
+            # 根据两个语音片段之间的静音长度填充前一个片段的结束位置和后一个片段的开始位置
+            if pending is None:
+                speech['start'] = int(max(0, speech['start'] - speech_pad_samples))
+                return None
+            silence_duration = speech['start'] - pending['end']
+            if silence_duration < 2 * speech_pad_samples:
+                pending['end'] += int(silence_duration // 2)
+                speech['start'] = int(max(0, speech['start'] - silence_duration // 2))
+            else:
+                pending['end'] = int(pending['end'] + speech_pad_samples)
+                speech['start'] = int(max(0, speech['start'] - speech_pad_samples))
+            return pending
+
+        def _output(speech):
+            samples = buffer[speech['start'] - buffer_start: speech['end'] - buffer_start]
+            return {'start': speech['start'], 'end': speech['end'], 'samples': samples}
+
+        for block in itertools.chain(audio_blocks, [None]):
+            is_end = block is None
+            if not is_end:
+                buffer = np.concatenate([buffer, block.astype(np.float32)])
+            audio_length_samples = buffer_start + len(buffer)
+            while audio_length_samples - current_start_sample >= window_size_samples or \
+                    (is_end and audio_length_samples > current_start_sample):
+                chunk = buffer[current_start_sample - buffer_start: current_start_sample - buffer_start + window_size_samples]
+                if len(chunk) < window_size_samples:
+                    chunk = np.pad(chunk, (0, int(window_size_samples - len(chunk))))
+                speech_prob = self(chunk, sampling_rate).item()
+
+                finished = None
+                if (speech_prob >= self.threshold) and temp_end:
+                    temp_end = 0
+                if (speech_prob >= self.threshold) and not triggered:
+                    triggered = True
+                    speech_start = current_start_sample
+                elif (speech_prob < neg_threshold) and triggered:
+                    if not temp_end:
+                        temp_end = current_start_sample
+                    if current_start_sample - temp_end >= min_silence_samples:
+                        if (temp_end - speech_start) > min_speech_samples:
+                            finished = {'start': speech_start, 'end': temp_end}
+                        temp_end = 0
+                        triggered = False
+                current_start_sample += window_size_samples
+
+                if finished is not None:
+                    last = _join(finished)
+                    if last is not None:
+                        yield _output(last)
+                    pending = finished
+                # 之后的语音片段与已经结束的语音片段的距离足够远，可以确定结束位置的填充
+                next_start = speech_start if triggered else current_start_sample
+                if pending is not None and next_start - pending['end'] >= 2 * speech_pad_samples:
+                    pending['end'] = int(min(audio_length_samples, pending['end'] + speech_pad_samples))
+                    yield _output(pending)
+                    pending = None
+            if is_end: break
+            # 丢弃不会再使用的音频
+            if pending is not None:
+                keep_start = pending['start']
+            elif triggered:
+                keep_start = int(max(0, speech_start - speech_pad_samples))
+            else:
+                keep_start = int(max(0, current_start_sample - speech_pad_samples))
+            buffer = buffer[keep_start - buffer_start:]
+            buffer_start = keep_start
+
+        if triggered and (audio_length_samples - speech_start) > min_speech_samples:
+            finished = {'start': speech_start, 'end': audio_length_samples}
+            last = _join(finished)
+            if last is not None:
+                yield _output(last)
+            pending = finished
+        if pending is not None:
+            pending['end'] = int(min(audio_length_samples, pending['end'] + speech_pad_samples))
+            yield _output(pending)
+
     def stream_vad(self, x, sampling_rate, return_seconds=False):
         """
 
@@ -1,15 +1,19 @@
+import copy
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BufferedReader
 
-import cn2an
 import numpy as np
 import yaml
 
 from ppasr import SUPPORT_MODEL
 from ppasr.data_utils.audio import AudioSegment
 from ppasr.data_utils.featurizer.audio_featurizer import AudioFeaturizer
+from ppasr.data_utils.featurizer.online_featurizer import OnlineAudioFeaturizer
 from ppasr.data_utils.featurizer.text_featurizer import TextFeaturizer
-from ppasr.decoders.ctc_greedy_decoder import greedy_decoder, greedy_decoder_chunk
+from ppasr.data_utils.utils import decode_audio_blocks
+from ppasr.decoders.ctc_greedy_decoder import greedy_decoder, greedy_decoder_batch, greedy_decoder_chunk
 from ppasr.infer_utils.inference_predictor import InferencePredictor
 from ppasr.utils.logger import setup_logger
 from ppasr.utils.utils import dict_to_object, print_arguments, download_model
@@ -24,7 +28,11 @@ class PPASRPredictor:
                  model_path='models/conformer_streaming_fbank/infer/',
                  use_pun=False,
                  pun_model_dir='models/pun_models/',
-                 use_gpu=True):
+                 use_gpu=True,
+                 is_itn=False,
+                 itn_cache_dir=None,
+                 use_tensorrt=False,
+                 optim_cache_dir=None):
         """
         语音识别预测工具
         :param configs: 配置文件路径或者是yaml读取到的配置参数
@@ -33,6 +41,10 @@ class PPASRPredictor:
         :param use_pun: 是否使用加标点符号的模型
         :param pun_model_dir: 给识别结果加标点符号的模型文件夹路径
         :param use_gpu: 是否使用GPU预测
+        :param is_itn: 是否在创建时就加载文本反标准化工具，否则在第一次使用时加载
+        :param itn_cache_dir: 保存编译好的文本反标准化FST的文件夹，为None时使用WeTextProcessing自带的FST
+        :param use_tensorrt: 是否使用TensorRT，第一次启动时只收集预热时各个输入的形状范围，之后的启动才使用TensorRT
+        :param optim_cache_dir: 保存IR优化之后的模型的文件夹，之后启动时直接加载，启动更快，为None时不使用
         """
         if configs:
             if isinstance(configs, str):
@@ -62,15 +74,18 @@ class PPASRPredictor:
         assert self.configs.use_model in SUPPORT_MODEL, f'没有该模型：{self.configs.use_model}'
         self.running = False
         self.inv_normalizer = None
+        self.itn_cache_dir = itn_cache_dir
         self.pun_predictor = None
         self.vad_predictor = None
+        self._feature_executor = None
         self._text_featurizer = TextFeaturizer(vocab_filepath=self.configs.dataset_conf.dataset_vocab)
         self._audio_featurizer = AudioFeaturizer(**self.configs.preprocess_conf)
         # 流式解码参数
-        self.remained_wav = None
+        self._online_featurizer = OnlineAudioFeaturizer(self._audio_featurizer)
         self.cached_feat = None
-        self.greedy_last_max_prob_list = None
-        self.greedy_last_max_index_list = None
+        self.greedy_state = None
+        # 流式反标准化的状态
+        self._itn_state = None
         self.__init_decoder()
         # 创建模型
         if not os.path.exists(model_path):
@@ -79,15 +94,79 @@ class PPASRPredictor:
         if use_pun:
             from ppasr.infer_utils.pun_predictor import PunctuationPredictor
             self.pun_predictor = PunctuationPredictor(model_dir=pun_model_dir, use_gpu=use_gpu)
+        # 文本反标准化工具，复制的预测器共享同一个
+        if is_itn:
+            self.__init_itn()
         # 获取预测器
         self.predictor = InferencePredictor(configs=self.configs,
                                             use_model=self.configs.use_model,
                                             streaming=self.configs.streaming,
                                             model_dir=model_path,
-                                            use_gpu=use_gpu)
-        # 预热
-        warmup_audio = np.random.uniform(low=-2.0, high=2.0, size=(134240,))
-        self.predict(audio_data=warmup_audio, is_itn=False)
+                                            use_gpu=use_gpu,
+                                            use_tensorrt=use_tensorrt,
+                                            optim_cache_dir=optim_cache_dir)
+        self._warmup()
+
+    # 预热
+    def _warmup(self, light=False):
+        """按照配置文件中warmup_conf的形状预热，覆盖不同的音频长度、批量大小和流式识别的缓存形状，
+        没有warmup_conf时使用默认参数
+
+        :param light: 只使用最短的音频执行一次模型推理，用于复制的预测器，模型和解码器已经由原预测器预热过
+        """
+        warmup_conf = self.configs.get('warmup_conf', None) or {}
+        durations = warmup_conf.get('durations', [8])
+        batch_sizes = warmup_conf.get('batch_sizes', [1])
+        stream_chunks = warmup_conf.get('stream_chunks', 0)
+        sample_rate = self.configs.preprocess_conf.sample_rate
+        if not self.predictor.support_batch:
+            batch_sizes = [1]
+        if light:
+            durations, batch_sizes, stream_chunks = [min(durations)], [1], 0
+        start = time.time()
+        # 完整执行一次识别，预热特征提取和解码器，解码器与音频长度无关，使用最短的音频
+        if not light:
+            warmup_audio = np.random.uniform(low=-2.0, high=2.0, size=(int(min(durations) * sample_rate),))
+            self.predict(audio_data=warmup_audio, sample_rate=sample_rate, is_itn=False)
+        # 只需要模型执行不同的形状，不需要解码
+        for duration in durations:
+            warmup_audio = np.random.uniform(low=-2.0, high=2.0, size=(int(duration * sample_rate),))
+            feature = self._featurize(warmup_audio, sample_rate)
+            for batch_size in batch_sizes:
+                input_data = np.repeat(feature[np.newaxis, :, :], batch_size, axis=0)
+                audio_len = np.full((batch_size,), feature.shape[0], dtype=np.int64)
+                self.predictor.predict(input_data, audio_len)
+        # 流式模型连续输入多个数据块，预热不同大小的缓存
+        if self.configs.streaming and stream_chunks > 0:
+            chunk_size = int(0.64 * sample_rate)
+            for i in range(stream_chunks):
+                warmup_audio = np.random.uniform(low=-2.0, high=2.0, size=(chunk_size,))
+                self.predict_stream(audio_data=warmup_audio, is_end=i == stream_chunks - 1, sample_rate=sample_rate)
+            self.set_stream_state(None)
+        logger.info(f'预热完成，音频长度：{durations}，批量大小：{batch_sizes}，流式数据块：{stream_chunks}，'
+                    f'耗时：{int((time.time() - start) * 1000)}ms')
+
+    def clone(self):
+        """复制一个预测器，新的预测器与当前预测器共享模型权重、语言模型、字典和标点符号模型的权重，
+        只有自己的推理上下文和流式识别状态，增加并发数量时只需要增加中间结果的内存
+
+        :return: 新的PPASRPredictor，只能在一个线程中使用
+        """
+        predictor = copy.copy(self)
+        predictor.predictor = self.predictor.clone()
+        if self.configs.decoder == 'ctc_beam_search':
+            predictor.beam_search_decoder = self.beam_search_decoder.clone()
+        if self.pun_predictor is not None:
+            predictor.pun_predictor = self.pun_predictor.clone()
+        # VAD的推理会话是共享的，模型状态保存在每个VADPredictor中
+        predictor.vad_predictor = None
+        predictor._online_featurizer = OnlineAudioFeaturizer(self._audio_featurizer)
+        predictor.cached_feat = None
+        predictor.greedy_state = None
+        predictor._itn_state = None
+        # 模型和解码器已经由当前预测器预热过，只需要执行一次短的推理初始化新的推理上下文
+        predictor._warmup(light=True)
+        return predictor
 
     # 初始化解码器
     def __init_decoder(self):
@@ -123,26 +202,45 @@ class PPASRPredictor:
             result = greedy_decoder(probs_seq=output_data, vocabulary=self._text_featurizer.vocab_list)
 
         score, text = result[0], result[1]
+        text = self._postprocess_text(text, use_pun=use_pun, is_itn=is_itn)
+        return score, text
+
+    # 对解码的文本加标点符号和反标准化
+    def _postprocess_text(self, text, use_pun, is_itn):
+        return self._postprocess_texts([text], use_pun=use_pun, is_itn=is_itn)[0]
+
+    # 对一批解码的文本加标点符号和反标准化，标点符号模型批量推理
+    def _postprocess_texts(self, texts, use_pun, is_itn):
         # 加标点符号
-        if use_pun and len(text) > 0:
+        if use_pun and any(len(text) > 0 for text in texts):
             if self.pun_predictor is not None:
-                text = self.pun_predictor(text)
+                try:
+                    texts = self.pun_predictor.predict_batch(texts)
+                except Exception as e:
+                    logger.error(f'加标点符号失败，错误信息：{e}')
             else:
                 logger.warning('标点符号模型没有初始化！')
         # 是否对文本进行反标准化
         if is_itn:
-            text = self.inverse_text_normalization(text)
-        return score, text
+            texts = [self.inverse_text_normalization(text) for text in texts]
+        return texts
+
+    @staticmethod
+    def _check_cancel(cancel_event):
+        if cancel_event is not None and cancel_event.is_set():
+            raise Exception('识别已取消')
 
     @staticmethod
     def _load_audio(audio_data, sample_rate=16000):
         """加载音频
-        :param audio_data: 需要识别的数据，支持文件路径，文件对象，字节，numpy。如果是字节的话，必须是完整的字节文件
+        :param audio_data: 需要识别的数据，支持文件路径，文件对象，字节，numpy，AudioSegment。如果是字节的话，必须是完整的字节文件
         :param sample_rate: 如果传入的事numpy数据，需要指定采样率
         :return: 识别的文本结果和解码的得分数
         """
         # 加载音频文件，并进行预处理
-        if isinstance(audio_data, str):
+        if isinstance(audio_data, AudioSegment):
+            audio_segment = audio_data
+        elif isinstance(audio_data, str):
             audio_segment = AudioSegment.from_file(audio_data)
         elif isinstance(audio_data, BufferedReader):
             audio_segment = AudioSegment.from_file(audio_data)
@@ -168,9 +266,7 @@ class PPASRPredictor:
         :return: 识别的文本结果和解码的得分数
         """
         # 加载音频文件，并进行预处理
-        audio_segment = self._load_audio(audio_data=audio_data, sample_rate=sample_rate)
-        audio_feature = self._audio_featurizer.featurize(audio_segment)
-        input_data = np.array(audio_feature).astype(np.float32)[np.newaxis, :]
+        input_data = self._featurize(audio_data=audio_data, sample_rate=sample_rate)[np.newaxis, :]
         audio_len = np.array([input_data.shape[1]]).astype(np.int64)
 
         # 运行predictor
@@ -181,23 +277,99 @@ class PPASRPredictor:
         result = {'text': text, 'score': score}
         return result
 
+    # 加载音频并提取特征
+    def _featurize(self, audio_data, sample_rate=16000):
+        audio_segment = self._load_audio(audio_data=audio_data, sample_rate=sample_rate)
+        audio_feature = self._audio_featurizer.featurize(audio_segment)
+        return np.array(audio_feature).astype(np.float32)
+
+    # 批量预测音频
+    def predict_batch(self,
+                      audios_data,
+                      use_pun=False,
+                      is_itn=False,
+                      sample_rate=16000,
+                      batch_size=16,
+                      num_workers=4,
+                      cancel_event=None):
+        """ 批量预测函数，每条音频只预测完整的一句话
+        :param audios_data: 需要识别的数据列表，每个元素支持文件路径，文件对象，字节，numpy，AudioSegment
+        :param use_pun: 是否使用加标点符号的模型
+        :param is_itn: 是否对文本进行反标准化
+        :param sample_rate: 如果传入的事numpy数据，需要指定采样率
+        :param batch_size: 每次推理的最大批量大小，流式的Conformer类模型只能为1
+        :param num_workers: 并行提取特征的线程数量
+        :param cancel_event: threading.Event，被设置之后在下一个批量之前停止识别并抛出异常，用于超时之后尽快释放预测器
+        :return: 与输入顺序一致的识别结果列表，每个元素包含识别的文本结果和解码的得分数
+        """
+        if len(audios_data) == 0: return []
+        # 并行加载音频和提取特征
+        if self._feature_executor is None:
+            self._feature_executor = ThreadPoolExecutor(max_workers=num_workers)
+        features = list(self._feature_executor.map(lambda d: self._featurize(d, sample_rate), audios_data))
+        if not self.predictor.support_batch:
+            batch_size = 1
+        # 按长度排序，减少同一批数据的填充
+        sorted_indexes = sorted(range(len(features)), key=lambda i: features[i].shape[0])
+        results = [None] * len(features)
+        for i in range(0, len(sorted_indexes), batch_size):
+            self._check_cancel(cancel_event)
+            batch_indexes = sorted_indexes[i:i + batch_size]
+            audio_len = np.array([features[idx].shape[0] for idx in batch_indexes]).astype(np.int64)
+            max_len = int(audio_len.max())
+            input_data = np.zeros((len(batch_indexes), max_len, features[batch_indexes[0]].shape[1]), dtype=np.float32)
+            for j, idx in enumerate(batch_indexes):
+                input_data[j, :audio_len[j], :] = features[idx]
+
+            # 运行predictor
+            output_data = self.predictor.predict(input_data, audio_len)
+            # 模型只输出填充后的结果，根据模型的降采样结构计算每条数据的有效输出长度，不会解码到填充的部分
+            output_lens = np.minimum(self.predictor.get_output_lens(audio_len), output_data.shape[1])
+
+            # 解码
+            if self.configs.decoder == 'ctc_beam_search':
+                # 集束搜索解码策略，整个批量使用多线程一起解码
+                probs_split = [output_data[j, :l] for j, l in enumerate(output_lens)]
+                batch_results = self.beam_search_decoder.decode_batch_beam_search_offline(probs_split=probs_split,
+                                                                                          return_score=True)
+            else:
+                # 贪心解码策略，整个批量一起解码
+                batch_results = zip(*greedy_decoder_batch(probs_split=output_data,
+                                                          vocabulary=self._text_featurizer.vocab_list,
+                                                          probs_lens=output_lens,
+                                                          return_score=True))
+            for idx, (score, text) in zip(batch_indexes, batch_results):
+                results[idx] = {'text': text, 'score': score}
+        # 全部文本一起批量加标点符号
+        texts = self._postprocess_texts([r['text'] for r in results], use_pun=use_pun, is_itn=is_itn)
+        for result, text in zip(results, texts):
+            result['text'] = text
+        return results
+
     # 长语音预测
     def predict_long(self,
                      audio_data,
                      use_pun=False,
                      is_itn=False,
-                     sample_rate=16000):
+                     sample_rate=16000,
+                     batch_size=16,
+                     num_workers=4,
+                     cancel_event=None):
         """
-        预测函数，只预测完整的一句话。
+        长语音预测函数，使用语音活动检测切分出多个语音片段，批量识别之后按时间顺序拼接
         :param audio_data: 需要识别的数据，支持文件路径，文件对象，字节，numpy。如果是字节的话，必须是完整的字节文件
         :param use_pun: 是否使用加标点符号的模型
         :param is_itn: 是否对文本进行反标准化
         :param sample_rate: 如果传入的事numpy数据，需要指定采样率
+        :param batch_size: 每次推理的最大批量大小，语音片段会按长度排序后组成批量
+        :param num_workers: 并行提取特征的线程数量
+        :param cancel_event: threading.Event，被设置之后尽快停止识别并抛出异常，用于超时之后尽快释放预测器
         :return: 识别的文本结果和解码的得分数
         """
         if self.vad_predictor is None:
             from ppasr.infer_utils.vad_predictor import VADPredictor
-            self.vad_predictor = VADPredictor()
+            # 长语音把音频切分成多段并行执行语音活动检测
+            self.vad_predictor = VADPredictor(num_lanes=16)
         # 加载音频文件，并进行预处理
         audio_segment = self._load_audio(audio_data=audio_data, sample_rate=sample_rate)
         # 重采样，方便进行语音活动检测
@@ -205,17 +377,22 @@ class PPASRPredictor:
             audio_segment.resample(self.configs.preprocess_conf.sample_rate)
         # 获取语音活动区域
         speech_timestamps = self.vad_predictor.get_speech_timestamps(audio_segment.samples, audio_segment.sample_rate)
+        if len(speech_timestamps) == 0:
+            return {'text': '', 'score': 0}
+        self._check_cancel(cancel_event)
+        # 批量识别全部语音片段，结果与语音片段的顺序一致
+        segments = [audio_segment.samples[t['start']: t['end']] for t in speech_timestamps]
+        results = self.predict_batch(audios_data=segments, use_pun=False, is_itn=is_itn,
+                                     sample_rate=audio_segment.sample_rate, batch_size=batch_size,
+                                     num_workers=num_workers, cancel_event=cancel_event)
         texts, scores = '', []
-        for t in speech_timestamps:
-            audio_ndarray = audio_segment.samples[t['start']: t['end']]
-            # 执行识别
-            result = self.predict(audio_data=audio_ndarray, use_pun=False, is_itn=is_itn)
+        for result in results:
             score, text = result['score'], result['text']
             if text != '':
                 texts = texts + text if use_pun else texts + '，' + text
             scores.append(score)
             logger.info(f'长语音识别片段结果：{text}')
-        if texts[0] == '，': texts = texts[1:]
+        if len(texts) > 0 and texts[0] == '，': texts = texts[1:]
         # 加标点符号
         if use_pun and len(texts) > 0:
             if self.pun_predictor is not None:
@@ -225,6 +402,44 @@ class PPASRPredictor:
         result = {'text': texts, 'score': round(sum(scores) / len(scores), 2)}
         return result
 
+    # 流式长语音预测
+    def predict_long_stream(self,
+                            audio_data,
+                            use_pun=False,
+                            is_itn=False,
+                            sample_rate=16000,
+                            block_duration=10):
+        """
+        流式长语音预测函数，分块读取音频并增量执行语音活动检测，每识别完成一个语音片段就返回结果，不会把整个音频加载到内存中
+        :param audio_data: 需要识别的数据，支持文件路径，文件对象，字节，numpy。如果是字节的话，必须是完整的字节文件
+        :param use_pun: 是否使用加标点符号的模型，每个语音片段单独加标点符号
+        :param is_itn: 是否对文本进行反标准化
+        :param sample_rate: 如果传入的事numpy数据，需要指定采样率
+        :param block_duration: 每次读取音频的长度，单位秒
+        :return: 语音片段识别结果的生成器，每个元素包含识别的文本结果、解码的得分数和语音片段的开始和结束时间（单位秒）
+        """
+        if self.vad_predictor is None:
+            from ppasr.infer_utils.vad_predictor import VADPredictor
+            # 长语音把音频切分成多段并行执行语音活动检测
+            self.vad_predictor = VADPredictor(num_lanes=16)
+        target_sample_rate = self.configs.preprocess_conf.sample_rate
+        block_size = int(block_duration * target_sample_rate)
+        if isinstance(audio_data, (np.ndarray, AudioSegment)):
+            # 已经在内存中的音频只需要分块
+            audio_segment = self._load_audio(audio_data=audio_data, sample_rate=sample_rate)
+            if audio_segment.sample_rate != target_sample_rate:
+                audio_segment.resample(target_sample_rate)
+            samples = audio_segment.samples
+            audio_blocks = (samples[i:i + block_size] for i in range(0, len(samples), block_size))
+        else:
+            audio_blocks = decode_audio_blocks(audio_data, sample_rate=target_sample_rate, block_size=block_size)
+        for segment in self.vad_predictor.speech_segments(audio_blocks, target_sample_rate):
+            result = self.predict(audio_data=segment['samples'], use_pun=use_pun, is_itn=is_itn,
+                                  sample_rate=target_sample_rate)
+            result['start'] = round(segment['start'] / target_sample_rate, 2)
+            result['end'] = round(segment['end'] / target_sample_rate, 2)
+            yield result
+
     # 预测音频
     def predict_stream(self,
                        audio_data,
@@ -255,20 +470,13 @@ class PPASRPredictor:
                                                      samp_width=samp_width, sample_rate=sample_rate)
         else:
             raise Exception(f'不支持该数据类型，当前数据类型为：{type(audio_data)}')
-        if self.remained_wav is None:
-            self.remained_wav = audio_data
-        else:
-            self.remained_wav = AudioSegment(np.concatenate([self.remained_wav.samples, audio_data.samples]),
-                                             audio_data.sample_rate)
 
-        # 预处理语音块
-        x_chunk = self._audio_featurizer.featurize(self.remained_wav)
-        x_chunk = np.array(x_chunk).astype(np.float32)[np.newaxis, :]
+        # 预处理语音块，只计算新输入音频的特征
+        x_chunk = self._online_featurizer.featurize(audio_data)[np.newaxis, :]
         if self.cached_feat is None:
             self.cached_feat = x_chunk
         else:
             self.cached_feat = np.concatenate([self.cached_feat, x_chunk], axis=1)
-        self.remained_wav._samples = self.remained_wav.samples[160 * x_chunk.shape[1]:]
 
         # 识别的数据块大小
         decoding_chunk_size = 16
@@ -309,14 +517,15 @@ class PPASRPredictor:
                 raise Exception(f'当前模型不支持该方法，当前模型为：{self.configs.use_model}')
             # 执行解码
             if self.configs.decoder == 'ctc_beam_search':
-                # 集束搜索解码策略
-                score, text = self.beam_search_decoder.decode_chunk(probs=output_chunk_probs, logits_lens=output_lens)
+                # 集束搜索解码策略，只输入数据块，全部数据块输入之后再获取结果
+                self.beam_search_decoder.feed_chunk(probs=output_chunk_probs, logits_lens=output_lens)
             else:
                 # 贪心解码策略
-                score, text, self.greedy_last_max_prob_list, self.greedy_last_max_index_list = \
+                score, text, self.greedy_state = \
                     greedy_decoder_chunk(probs_seq=output_chunk_probs[0], vocabulary=self._text_featurizer.vocab_list,
-                                         last_max_index_list=self.greedy_last_max_index_list,
-                                         last_max_prob_list=self.greedy_last_max_prob_list)
+                                         state=self.greedy_state)
+        if self.configs.decoder == 'ctc_beam_search':
+            score, text = self.beam_search_decoder.get_chunk_result()
         # 更新特征缓存
         self.cached_feat = self.cached_feat[:, end - cached_feature_num:, :]
 
@@ -326,32 +535,73 @@ class PPASRPredictor:
                 text = self.pun_predictor(text)
             else:
                 logger.warning('标点符号模型没有初始化！')
-        # 是否对文本进行反标准化
+        # 是否对文本进行反标准化，识别过程中只对新的文本进行反标准化
         if is_itn:
-            text = self.inverse_text_normalization(text)
+            if self._itn_state is None:
+                self._itn_state = self.create_itn_stream_state()
+            text = self.inverse_text_normalization_stream(self._itn_state, text)
 
         result = {'text': text, 'score': score}
         return result
 
+    # 获取流式识别的全部状态，用于多个会话轮流使用同一个预测器
+    def get_stream_state(self):
+        state = {'online_featurizer': self._online_featurizer,
+                 'cached_feat': self.cached_feat,
+                 'greedy_state': self.greedy_state,
+                 'itn_state': self._itn_state,
+                 'predictor': self.predictor.get_stream_state()}
+        if self.configs.decoder == 'ctc_beam_search':
+            state['beam_search_decoder'] = self.beam_search_decoder.beam_search_decoder
+        return state
+
+    # 恢复流式识别的状态，如果为None就是新的会话
+    def set_stream_state(self, state=None):
+        if state is None:
+            self.reset_stream()
+            # 集束搜索的解码状态保存在解码器内部，新的会话需要使用新的解码器
+            if self.configs.decoder == 'ctc_beam_search':
+                self.beam_search_decoder.beam_search_decoder = self.beam_search_decoder.create_stream_decoder()
+            return
+        self._online_featurizer = state['online_featurizer']
+        self.cached_feat = state['cached_feat']
+        self.greedy_state = state['greedy_state']
+        self._itn_state = state['itn_state']
+        self.predictor.set_stream_state(state['predictor'])
+        if self.configs.decoder == 'ctc_beam_search':
+            self.beam_search_decoder.beam_search_decoder = state['beam_search_decoder']
+
     # 重置流式识别，每次流式识别完成之后都要执行
     def reset_stream(self):
         self.predictor.reset_stream()
-        self.remained_wav = None
+        self._online_featurizer = OnlineAudioFeaturizer(self._audio_featurizer)
         self.cached_feat = None
-        self.greedy_last_max_prob_list = None
-        self.greedy_last_max_index_list = None
+        self.greedy_state = None
+        self._itn_state = None
         if self.configs.decoder == 'ctc_beam_search':
             self.beam_search_decoder.reset_decoder()
 
+    # 初始化文本反标准化工具
+    def __init_itn(self):
+        from ppasr.infer_utils.itn_normalizer import InverseTextNormalizer
+        use_cn2an = self.configs.decoder == 'ctc_beam_search'
+        if use_cn2an:
+            logger.warning("当解码器为ctc_beam_search时，因为包冲突，不能使用WeTextProcessing，使用cn2an进行文本反标准化")
+        self.inv_normalizer = InverseTextNormalizer(cache_dir=self.itn_cache_dir, use_cn2an=use_cn2an)
+
     # 对文本进行反标准化
     def inverse_text_normalization(self, text):
-        if self.configs.decoder == 'ctc_beam_search':
-            logger.error("当解码器为ctc_beam_search时，因为包冲突，不能使用文本反标准化")
-            text = cn2an.transform(text, "cn2an")
-            return text
         if self.inv_normalizer is None:
-            # 需要安装WeTextProcessing>=0.1.0
-            from itn.chinese.inverse_normalizer import InverseNormalizer
-            self.inv_normalizer = InverseNormalizer()
-        result_text = self.inv_normalizer.normalize(text)
-        return result_text
+            self.__init_itn()
+        return self.inv_normalizer(text)
+
+    # 创建流式反标准化的状态，每个流式句子一个
+    def create_itn_stream_state(self):
+        from ppasr.infer_utils.itn_normalizer import StreamITNState
+        return StreamITNState()
+
+    # 对流式识别的文本进行增量反标准化，已经确定的前缀不会重新反标准化
+    def inverse_text_normalization_stream(self, state, text, stable_len=None):
+        if self.inv_normalizer is None:
+            self.__init_itn()
+        return self.inv_normalizer.normalize_stream(state, text, stable_len=stable_len)
@@ -285,10 +285,10 @@ class PPASRTrainer(object):
                 self.configs.decoder = 'ctc_greedy'
 
         # 执行解码
-        outs = [outs[i, :, :] for i, _ in enumerate(range(outs.shape[0]))]
         if self.configs.decoder == 'ctc_greedy':
             result = greedy_decoder_batch(outs, vocabulary)
         else:
+            outs = [outs[i, :, :] for i, _ in enumerate(range(outs.shape[0]))]
             result = self.beam_search_decoder.decode_batch_beam_search_offline(probs_split=outs)
         return result
 
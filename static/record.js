@@ -101,11 +101,14 @@ var PPASRRecorder = function (stream, url, textResult) {
     }
 
     // WebSocket客户端操作
+    // 识别结果保存在字符串中，innerText会合并空白字符，不能用来计算offset
+    let text = '';
     //连接成功建立的回调方法
     socket.onopen = () => {
         socket.binaryType = 'arraybuffer';
         this.start();
-        textResult.innerText = ''
+        text = '';
+        textResult.innerText = text
     };
     //接收到消息的回调方法
     socket.onmessage = function (MesssageEvent) {
@@ -115,7 +118,9 @@ var PPASRRecorder = function (stream, url, textResult) {
         let data = JSON.parse(jsonStr)
         let code = data['code'];
         if (code === 0){
-            textResult.innerText = data['result']
+            // 服务器只返回变化的部分，从offset开始的文本替换为delta
+            text = text.substring(0, data['offset']) + data['delta'];
+            textResult.innerText = text
         }else {
             let msg = data['msg'];
             alert('报错，错误信息：' + msg)
@@ -135,18 +140,30 @@ var PPASRRecorder = function (stream, url, textResult) {
 // WebSocket客户端
 PPASRWebSocket = function useWebSocket(url, record, textResult) {
     ws = new WebSocket(url);
+    // 识别结果保存在字符串中，innerText会合并空白字符，不能用来计算offset
+    let text = '';
     //连接成功建立的回调方法
     ws.onopen = function () {
         ws.binaryType = 'arraybuffer';
         record.start();
-        textResult.innerText = ''
+        text = '';
+        textResult.innerText = text
     };
     //接收到消息的回调方法
     ws.onmessage = function (MesssageEvent) {
         //返回结果
         var jsonStr = MesssageEvent.data;
         console.log(jsonStr)
-        textResult.innerText = JSON.parse(jsonStr)['result']
+        let data = JSON.parse(jsonStr)
+        let code = data['code'];
+        if (code === 0){
+            // 服务器只返回变化的部分，从offset开始的文本替换为delta
+            text = text.substring(0, data['offset']) + data['delta'];
+            textResult.innerText = text
+        }else {
+            let msg = data['msg'];
+            alert('报错，错误信息：' + msg)
+        }
     }
     //连接关闭的回调方法
     ws.onerror = function (err) {
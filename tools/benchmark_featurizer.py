@@ -0,0 +1,64 @@
+"""对比paddle和numpy两种特征计算后端的速度和结果误差"""
+
+import argparse
+import functools
+import time
+
+import numpy as np
+
+from ppasr.data_utils.audio import AudioSegment
+from ppasr.data_utils.featurizer.audio_featurizer import AudioFeaturizer
+from ppasr.data_utils.featurizer.online_featurizer import OnlineAudioFeaturizer
+from ppasr.utils.utils import add_arguments, print_arguments
+
+parser = argparse.ArgumentParser(description=__doc__)
+add_arg = functools.partial(add_arguments, argparser=parser)
+add_arg('wav_path',         str,    'dataset/test.wav',   "测试音频的路径")
+add_arg('feature_method',   str,    'fbank',              "音频预处理方法，支持：mfcc、fbank")
+add_arg('n_mels',           int,    80,                   "计算fbank得到的mel大小")
+add_arg('n_mfcc',           int,    40,                   "计算mfcc得到的mfcc大小")
+add_arg('chunk_ms',         int,    0,                    "模拟流式识别每次输入的音频长度，单位毫秒，使用流式特征器计算，为0时计算整段音频")
+add_arg('num_runs',         int,    50,                   "每个后端重复计算的次数")
+args = parser.parse_args()
+
+
+def featurize(featurizer, segments):
+    if args.chunk_ms > 0:
+        # 与流式识别一样使用流式特征器，每次只计算新输入音频的特征
+        online_featurizer = OnlineAudioFeaturizer(featurizer)
+        return [online_featurizer.featurize(AudioSegment(s.samples, s.sample_rate)) for s in segments]
+    return [featurizer.featurize(AudioSegment(s.samples, s.sample_rate)) for s in segments]
+
+
+def benchmark():
+    print_arguments(args=args)
+    audio_segment = AudioSegment.from_file(args.wav_path)
+    featurizers = {backend: AudioFeaturizer(feature_method=args.feature_method,
+                                            n_mels=args.n_mels,
+                                            n_mfcc=args.n_mfcc,
+                                            sample_rate=audio_segment.sample_rate,
+                                            feature_backend=backend) for backend in ['paddle', 'numpy']}
+    # 切分成多个音频块
+    if args.chunk_ms > 0:
+        chunk_size = audio_segment.sample_rate * args.chunk_ms // 1000
+        samples = audio_segment.samples
+        segments = [AudioSegment(samples[i:i + chunk_size], audio_segment.sample_rate)
+                    for i in range(0, len(samples), chunk_size)]
+    else:
+        segments = [audio_segment]
+
+    features = {}
+    for backend, featurizer in featurizers.items():
+        features[backend] = featurize(featurizer, segments)
+        start = time.time()
+        for _ in range(args.num_runs):
+            featurize(featurizer, segments)
+        cost = (time.time() - start) * 1000 / args.num_runs
+        print(f'{backend}后端：每次计算{len(segments)}个音频块平均耗时：{cost:.2f}ms')
+    max_diff = max((np.abs(p - n).max() for p, n in zip(features['paddle'], features['numpy']) if p.shape[0] > 0),
+                   default=0.0)
+    print(f'两种后端计算结果的最大绝对误差：{max_diff:.6f}')
+
+
+if __name__ == '__main__':
+    benchmark()
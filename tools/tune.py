@@ -42,16 +42,17 @@ def tune():
 
     print('开始使用识别结果解码...')
     print('解码alpha和beta的排列：%s' % params_grid)
+    # 只创建一次训练器，模型和语言模型只加载一次，之后只修改解码器的参数
+    configs['decoder'] = 'ctc_beam_search'
+    configs['ctc_beam_search_decoder_conf']['alpha'], configs['ctc_beam_search_decoder_conf']['beta'] = params_grid[0]
+    trainer = PPASRTrainer(configs=configs, use_gpu=args.use_gpu)
+    resume_model = args.resume_model.format(configs['use_model'], configs['preprocess_conf']['feature_method'])
     # 搜索alphas参数和betas参数
     best_alpha, best_beta, best_result = 0, 0, 1
     for i, (alpha, beta) in enumerate(params_grid):
-        # 获取训练器
-        configs['decoder'] = 'ctc_beam_search'
-        configs['ctc_beam_search_decoder_conf']['alpha'] = alpha
-        configs['ctc_beam_search_decoder_conf']['beta'] = beta
-        trainer = PPASRTrainer(configs=configs, use_gpu=args.use_gpu)
-        _, error_result = trainer.evaluate(resume_model=args.resume_model.format(configs['use_model'],
-                                                                                 configs['preprocess_conf'][ 'feature_method']))
+        if trainer.beam_search_decoder is not None:
+            trainer.beam_search_decoder.reset_params(alpha, beta)
+        _, error_result = trainer.evaluate(resume_model=resume_model if i == 0 else None)
         if error_result < best_result:
             best_alpha = alpha
             best_beta = beta